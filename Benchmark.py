@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# Run benchmarks with python Benchmark.py <benchmark> [options]
+# See `python Benchmark.py -h` for the list of benchmarks.
+# Benchmarks only generate spoilers, so no ROM is required.
+
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+test_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests')
+
+
+def load_preset(preset, seed, output_dir):
+    with open(os.path.join(test_dir, preset + '.sav')) as f:
+        settings_dict = json.load(f)
+    return spoiler_only_settings(settings_dict, preset, seed, output_dir)
+
+
+# Plando files are run with the settings they contain, like in Unittest.py.
+def load_plando(plando, seed, output_dir):
+    distribution_file = os.path.join(test_dir, 'plando', plando + '.json')
+    with open(distribution_file) as f:
+        settings_dict = json.load(f).get('settings', {})
+    settings_dict.update({
+        'enable_distribution_file': True,
+        'distribution_file': distribution_file,
+    })
+    return spoiler_only_settings(settings_dict, plando, seed, output_dir)
+
+
+def spoiler_only_settings(settings_dict, name, seed, output_dir):
+    from Settings import Settings
+
+    settings_dict.update({
+        'create_patch_file': False,
+        'create_compressed_rom': False,
+        'create_wad_file': False,
+        'create_uncompressed_rom': False,
+        'count': 1,
+        'create_spoiler': True,
+        'output_file': os.path.join(output_dir, name),
+        'seed': seed,
+    })
+    return Settings(settings_dict, strict=True)
+
+
+# Runs in its own process, so that peak RSS only covers this preset.
+def run_search_memory(preset, seed):
+    from Fill import FillIndex
+    from Main import main
+    from Profiler import peak_rss
+    from Search import Search, cache_containers
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        main(load_preset(preset, seed, output_dir))
+        elapsed = time.perf_counter() - start
+    forks = Search.cache_stats['forks']
+    return {
+        'preset': preset,
+        'seconds': elapsed,
+        'peak_rss_mb': peak_rss(),
+        'cache_forks': forks,
+        # An estimate, not a measurement: copying a search used to copy every
+        # container up front, so the old path would have made this many copies.
+        'estimated_eager_copies': forks * len(cache_containers),
+        'container_copies': Search.cache_stats['copies'],
+        'fill_rule_checks': FillIndex.cache_stats['rule_checks'],
+        'fill_rule_hits': FillIndex.cache_stats['rule_hits'],
+        'fill_locations_skipped': FillIndex.cache_stats['locations_skipped'],
+    }
+
+
+def search_memory(args):
+    presets = args.presets or ['multiworld', 'entrance', 'entrance2', 'entrance3', 'entrance-warps']
+    ctx = multiprocessing.get_context('spawn')
+    print('%-16s %9s %9s %9s %17s %12s %12s %12s %12s' % (
+        'preset', 'seconds', 'peak MB', 'forks', 'est. eager copies', 'copies',
+        'fill checks', 'fill hits', 'fill skipped'))
+    for preset in presets:
+        with ctx.Pool(1) as pool:
+            result = pool.apply(run_search_memory, (preset, args.seed))
+        print('%-16s %9.2f %9.1f %9d %17d %12d %12d %12d %12d' % (
+            result['preset'], result['seconds'], result['peak_rss_mb'] or 0, result['cache_forks'],
+            result['estimated_eager_copies'], result['container_copies'],
+            result['fill_rule_checks'], result['fill_rule_hits'], result['fill_locations_skipped']))
+
+
+# Runs in its own process, so that no logic is cached from other runs.
+def run_world_build(preset, seed, world_count):
+    from Main import build_world_graphs, resolve_settings
+    from RuleParser import Rule_AST_Transformer
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        settings = load_preset(preset, seed, output_dir)
+        settings.world_count = world_count
+        resolve_settings(settings)
+        start = time.perf_counter()
+        build_world_graphs(settings)
+        elapsed = time.perf_counter() - start
+    cache_stats = Rule_AST_Transformer.cache_stats
+    return {
+        'world_count': world_count,
+        'seconds': elapsed,
+        'seconds_per_world': elapsed / world_count,
+        'files_parsed': cache_stats['files_parsed'],
+        'files_shared': cache_stats['files_shared'],
+    }
+
+
+def world_build(args):
+    ctx = multiprocessing.get_context('spawn')
+    print('%-12s %9s %9s %12s %12s' % ('world count', 'seconds', 'per world', 'files parsed', 'files shared'))
+    for world_count in args.world_counts:
+        with ctx.Pool(1) as pool:
+            result = pool.apply(run_world_build, (args.preset, args.seed, world_count))
+        print('%-12d %9.2f %9.3f %12d %12d' % (
+            result['world_count'], result['seconds'], result['seconds_per_world'],
+            result['files_parsed'], result['files_shared']))
+
+
+# Runs in its own process, so that imports and in-memory caches start cold.
+def run_startup(preset, seed, output_dir, logic_cache):
+    start = time.perf_counter()
+    from Main import build_world_graphs, resolve_settings
+    imported = time.perf_counter()
+
+    settings = load_preset(preset, seed, output_dir)
+    settings.output_dir = output_dir
+    settings.logic_cache = logic_cache
+    settings.world_count = 1
+    resolve_settings(settings)
+    resolved = time.perf_counter()
+    build_world_graphs(settings)
+    built = time.perf_counter()
+    return {
+        'import_seconds': imported - start,
+        'settings_seconds': resolved - imported,
+        'build_seconds': built - resolved,
+        'seconds': built - start,
+    }
+
+
+def startup(args):
+    ctx = multiprocessing.get_context('spawn')
+    print('%-10s %9s %9s %9s %9s' % ('cache', 'import', 'settings', 'build', 'total'))
+    with tempfile.TemporaryDirectory() as output_dir:
+        # The cold run fills the on-disk caches that the warm run reads.
+        for name, logic_cache in [('none', False), ('cold', True), ('warm', True)]:
+            with ctx.Pool(1) as pool:
+                result = pool.apply(run_startup, (args.preset, args.seed, output_dir, logic_cache))
+            print('%-10s %9.3f %9.3f %9.3f %9.3f' % (
+                name, result['import_seconds'], result['settings_seconds'],
+                result['build_seconds'], result['seconds']))
+
+
+# Times each implementation of the header checksum on random data, and the
+# check that lets Rom.update_header skip it when the data is unchanged.
+def header_crc(args):
+    import crc
+    from ntype import BigStream
+    from Utils import import_numpy
+
+    rng = random.Random(args.seed)
+    rom = BigStream(bytearray(rng.getrandbits(0x8100000).to_bytes(0x1020000, 'big')))
+    data = crc.crc_data(rom)
+    implementations = [('reference', crc.crc_reference), ('python', crc.crc_python)]
+    if import_numpy() is not None:
+        implementations.append(('numpy', crc.crc_numpy))
+
+    print('%-12s %12s %9s' % ('crc', 'seconds', 'matches'))
+    expected = crc.crc_reference(*data)
+    for name, implementation in implementations:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            result = implementation(*data)
+        print('%-12s %12.4f %9s' % (name, (time.perf_counter() - start) / args.repeat, result == expected))
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        unchanged = crc.crc_data(rom) == data
+    print('%-12s %12.4f %9s' % ('unchanged', (time.perf_counter() - start) / args.repeat, unchanged))
+
+
+# Writes and reads back synthetic patch data, both held whole in memory and
+# streamed through N64Patch.PatchWriter and PatchReader, reporting throughput
+# and the peak memory traced while doing so.
+def patch_stream(args):
+    import io
+    import tracemalloc
+    import zlib
+    from N64Patch import PatchReader, PatchWriter
+    from ntype import BigStream
+
+    # blocks of ROM-like data: runs of 0s between random bytes
+    rng = random.Random(args.seed)
+    blocks = [bytes(rng.choice([0, 0, rng.getrandbits(8)]) for _ in range(0x1000)) for _ in range(64)]
+    block_count = args.size * 0x100
+    size = block_count * 0x1000
+
+    def write_memory(outfile):
+        patch_data = BigStream([])
+        for i in range(block_count):
+            patch_data.append_bytes(blocks[i % len(blocks)])
+        outfile.write(zlib.compress(bytes(patch_data.buffer)))
+
+    def write_stream(outfile):
+        patch_data = PatchWriter(outfile)
+        for i in range(block_count):
+            patch_data.append_bytes(blocks[i % len(blocks)])
+        patch_data.close()
+
+    def read_memory(stream):
+        patch_data = BigStream(zlib.decompress(stream.read()))
+        while not patch_data.eof():
+            patch_data.read_bytes(length=0x1000)
+
+    def read_stream(stream):
+        patch_data = PatchReader(stream)
+        while not patch_data.eof():
+            patch_data.read_bytes(length=0x1000)
+
+    print('%-14s %9s %9s %9s' % ('patch stream', 'seconds', 'MB/s', 'peak MB'))
+    patch_file = io.BytesIO()
+    write_stream(patch_file)
+    for name, run, make_file in [
+            ('write memory', write_memory, io.BytesIO), ('write stream', write_stream, io.BytesIO),
+            ('read memory', read_memory, lambda: io.BytesIO(patch_file.getvalue())),
+            ('read stream', read_stream, lambda: io.BytesIO(patch_file.getvalue()))]:
+        start = time.perf_counter()
+        run(make_file())
+        elapsed = time.perf_counter() - start
+        # tracing slows the run down, so memory is measured on a separate one
+        stream = make_file()
+        tracemalloc.start()
+        run(stream)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('%-14s %9.2f %9.1f %9.1f' % (name, elapsed, size / elapsed / 0x100000, peak / 0x100000))
+
+
+# The totals compared against a baseline, summed over the seeds of a preset
+suite_metrics = ('wall_seconds', 'cpu_seconds', 'peak_rss_mb', 'searches', 'spheres', 'rule_checks')
+
+
+# Runs in its own process, so that caches start cold and peak RSS only covers this seed.
+# Returns the stages recorded by --profile_stages, or the error if generation failed.
+def run_suite_seed(name, seed):
+    from Main import main
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        if name.startswith('plando/'):
+            settings = load_plando(name[len('plando/'):], seed, output_dir)
+        else:
+            settings = load_preset(name, seed, output_dir)
+        settings.profile_stages = True
+        try:
+            main(settings)
+        except Exception as e:
+            return {'seed': seed, 'error': '%s: %s' % (type(e).__name__, e)}
+        with open(settings.output_file + '_Profile.json') as f:
+            profile = json.load(f)
+    return {'seed': seed, 'error': None, 'stages': profile['stages']}
+
+
+def summarize_suite_runs(runs):
+    summary = {metric: 0 for metric in suite_metrics}
+    stages = {}
+    for run in runs:
+        if run['error'] is not None:
+            continue
+        for stage in run['stages']:
+            if stage['depth'] == 0:
+                for metric in suite_metrics:
+                    if metric == 'peak_rss_mb':
+                        summary[metric] = max(summary[metric], stage[metric] or 0)
+                    else:
+                        summary[metric] += stage[metric]
+            stages[stage['stage']] = stages.get(stage['stage'], 0) + stage['cpu_seconds']
+    summary['errors'] = {run['seed']: run['error'] for run in runs if run['error'] is not None}
+    summary['stage_cpu_seconds'] = stages
+    return summary
+
+
+# Returns a description of each total that grew by more than the threshold over the baseline.
+def suite_regressions(results, baseline, threshold):
+    regressions = []
+    for name, summary in results.items():
+        if name not in baseline:
+            continue
+        for metric in suite_metrics:
+            old, new = baseline[name].get(metric), summary[metric]
+            if old and new > old * (1 + threshold):
+                regressions.append('%s %s: %.3f -> %.3f (+%.0f%%)' % (name, metric, old, new, (new / old - 1) * 100))
+        for seed in summary['errors']:
+            if seed not in baseline[name].get('errors', {}):
+                regressions.append('%s seed %s: %s' % (name, seed, summary['errors'][seed]))
+    return regressions
+
+
+def suite(args):
+    names = args.presets or sorted(os.path.splitext(os.path.basename(path))[0] for path in glob.glob(os.path.join(test_dir, '*.sav')))
+    names += ['plando/' + plando for plando in args.plando]
+    seeds = ['%s-%d' % (args.seed, i) for i in range(args.seeds)]
+    ctx = multiprocessing.get_context('spawn')
+
+    results = {}
+    print('%-28s %9s %9s %9s %9s %9s %11s %7s' % ('preset', 'seconds', 'cpu', 'peak MB', 'searches', 'spheres', 'rule checks', 'errors'))
+    for name in names:
+        runs = []
+        for seed in seeds:
+            with ctx.Pool(1) as pool:
+                runs.append(pool.apply(run_suite_seed, (name, seed)))
+        summary = results[name] = summarize_suite_runs(runs)
+        print('%-28s %9.2f %9.2f %9.1f %9d %9d %11d %7d' % (
+            name, summary['wall_seconds'], summary['cpu_seconds'], summary['peak_rss_mb'], summary['searches'],
+            summary['spheres'], summary['rule_checks'], len(summary['errors'])))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'seeds': seeds, 'results': results}, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['seeds'] != seeds:
+            sys.exit('The baseline was recorded with seeds %s, not %s.' % (', '.join(baseline['seeds']), ', '.join(seeds)))
+        regressions = suite_regressions(results, baseline['results'], args.threshold)
+        if regressions:
+            print('Regressions over %.0f%% against %s:' % (args.threshold * 100, args.baseline))
+            for regression in regressions:
+                print('  ' + regression)
+            sys.exit(1)
+        print('No regressions over %.0f%% against %s.' % (args.threshold * 100, args.baseline))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Randomizer performance benchmarks.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parser_search = subparsers.add_parser('search-memory', help='Peak memory and sphere cache copies during generation.')
+    parser_search.add_argument('presets', nargs='*', help='Names of tests/*.sav presets to run.')
+    parser_search.add_argument('--seed', default='BENCHMARK', help='Seed to generate.')
+    parser_search.set_defaults(func=search_memory)
+
+    parser_build = subparsers.add_parser('world-build', help='Time to build the world graphs for increasing world counts.')
+    parser_build.add_argument('world_counts', nargs='*', type=int, default=[1, 8, 32, 64], help='World counts to build.')
+    parser_build.add_argument('--preset', default='multiworld', help='Name of the tests/*.sav preset to build.')
+    parser_build.add_argument('--seed', default='BENCHMARK', help='Seed to generate.')
+    parser_build.set_defaults(func=world_build)
+
+    parser_startup = subparsers.add_parser('startup', help='Time to the first world built in a fresh process, with and without on-disk caches.')
+    parser_startup.add_argument('--preset', default='plentiful', help='Name of the tests/*.sav preset to build.')
+    parser_startup.add_argument('--seed', default='BENCHMARK', help='Seed to generate.')
+    parser_startup.set_defaults(func=startup)
+
+    parser_suite = subparsers.add_parser('suite', help='Generate a fixed set of seeds for each preset, optionally comparing against a baseline.')
+    parser_suite.add_argument('presets', nargs='*', help='Names of tests/*.sav presets to run. Defaults to all of them.')
+    parser_suite.add_argument('--plando', nargs='*', default=[], help='Names of tests/plando/*.json files to also run.')
+    parser_suite.add_argument('--seed', default='BENCHMARK', help='Prefix of the seeds to generate.')
+    parser_suite.add_argument('--seeds', type=int, default=3, help='Number of seeds to generate for each preset.')
+    parser_suite.add_argument('--output', help='Write the results to this file, which can be used as a baseline.')
+    parser_suite.add_argument('--baseline', help='Results of an earlier run to compare against. Exits with an error on regressions.')
+    parser_suite.add_argument('--threshold', type=float, default=0.25, help='Fraction a total may grow over the baseline before it counts as a regression.')
+    parser_suite.set_defaults(func=suite)
+
+    parser_crc = subparsers.add_parser('crc', help='Time each implementation of the ROM header checksum.')
+    parser_crc.add_argument('--repeat', type=int, default=5, help='Number of times to compute each checksum.')
+    parser_crc.add_argument('--seed', default='BENCHMARK', help='Seed of the random ROM data.')
+    parser_crc.set_defaults(func=header_crc)
+
+    parser_patch = subparsers.add_parser('patch-stream', help='Throughput and peak memory of writing and reading patch files.')
+    parser_patch.add_argument('--size', type=int, default=16, help='MB of uncompressed patch data.')
+    parser_patch.add_argument('--seed', default='BENCHMARK', help='Seed of the random patch data.')
+    parser_patch.set_defaults(func=patch_stream)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from Region import TimeOfDay
+from Region import TimeOfDay, all_rules, no_rule
 
 
 class Entrance(object):
@@ -8,7 +8,7 @@ class Entrance(object):
         self.parent_region = parent
         self.world = parent.world
         self.connected_region = None
-        self.access_rule = lambda state, **kwargs: True
+        self.access_rule = no_rule
         self.access_rules = []
         self.reverse = None
         self.replaces = None
@@ -47,7 +47,7 @@ class Entrance(object):
         if self.never:
             return
         self.access_rules.append(lambda_rule)
-        self.access_rule = lambda state, **kwargs: all(rule(state, **kwargs) for rule in self.access_rules)
+        self.access_rule = all_rules(self.access_rules)
 
 
     def set_rule(self, lambda_rule):
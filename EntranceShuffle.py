@@ -3,7 +3,7 @@ import logging
 from itertools import chain
 from Fill import ShuffleError
 from collections import OrderedDict
-from Search import Search
+from Search import Search, AssumedSearch
 from Region import TimeOfDay
 from Rules import set_entrances_based_rules
 from Entrance import Entrance
@@ -355,7 +355,11 @@ def set_entrances(worlds):
         world.initialize_entrances()
 
     if worlds[0].entrance_shuffle:
-        shuffle_random_entrances(worlds)
+        try:
+            shuffle_random_entrances(worlds)
+        finally:
+            # the kept searches hold on to the worlds
+            validation_search.kept.clear()
 
     set_entrances_based_rules(worlds)
 
@@ -710,6 +714,7 @@ def validate_world(world, worlds, entrance_placed, locations_to_ensure_reachable
     # Warp Songs and Overworld Spawns can also end up inside certain indoors so those need to be handled as well
     CHILD_FORBIDDEN = ['OGC Great Fairy Fountain -> Castle Grounds', 'GV Carpenter Tent -> GV Fortress Side']
     ADULT_FORBIDDEN = ['HC Great Fairy Fountain -> Castle Grounds', 'HC Storms Grotto -> Castle Grounds']
+    time_travel_search = None
 
     for entrance in world.get_shufflable_entrances():
         if entrance.shuffled:
@@ -725,7 +730,7 @@ def validate_world(world, worlds, entrance_placed, locations_to_ensure_reachable
                 raise EntranceShuffleError('%s is potentially accessible as adult' % entrance.name)
 
     if locations_to_ensure_reachable:
-        max_search = Search.max_explore([w.state for w in worlds], itempool)
+        max_search = validation_search('max', worlds, itempool)
         # If ALR is enabled, ensure all locations we want to keep reachable are indeed still reachable
         # Otherwise, just continue if the game is still beatable
         if not (world.check_beatable_only and max_search.can_beat_game(False)):
@@ -753,14 +758,14 @@ def validate_world(world, worlds, entrance_placed, locations_to_ensure_reachable
        (entrance_placed == None or entrance_placed.type in ['SpecialInterior', 'Overworld', 'Spawn', 'WarpSong', 'OwlDrop']):
         # At least one valid starting region with all basic refills should be reachable without using any items at the beginning of the seed
         # Note this creates new empty states rather than reuse the worlds' states (which already have starting items)
-        no_items_search = Search([State(w) for w in worlds])
+        no_items_search = validation_search('no items', worlds)
 
         valid_starting_regions = ['Kokiri Forest', 'Kakariko Village']
         if not any(region for region in valid_starting_regions if no_items_search.can_reach(world.get_region(region))):
             raise EntranceShuffleError('Invalid starting area')
 
         # Check that a region where time passes is always reachable as both ages without having collected any items
-        time_travel_search = Search.with_items([w.state for w in worlds], [ItemFactory('Time Travel', world=w) for w in worlds])
+        time_travel_search = validation_search('time travel', worlds)
 
         if not (any(region for region in time_travel_search.reachable_regions('child') if region.time_passes and region.world == world) and
                 any(region for region in time_travel_search.reachable_regions('adult') if region.time_passes and region.world == world)):
@@ -778,12 +783,63 @@ def validate_world(world, worlds, entrance_placed, locations_to_ensure_reachable
         # The Big Poe Shop should always be accessible as adult without the need to use any bottles
         # This is important to ensure that players can never lock their only bottles by filling them with Big Poes they can't sell
         # We can use starting items in this check as long as there are no exits requiring the use of a bottle without refills
-        time_travel_search = Search.with_items([w.state for w in worlds], [ItemFactory('Time Travel', world=w) for w in worlds])
+        if time_travel_search is None:
+            time_travel_search = validation_search('time travel', worlds)
 
         if not time_travel_search.can_reach(world.get_region('Market Guard House'), age='adult'):
             raise EntranceShuffleError('Big Poe Shop access is not guaranteed as adult')
 
 
+# Returns a search of the worlds for validate_world, of one of these kinds:
+#  'max': with every item of the pool, and every location explored
+#  'no items': with none of the items, not even the starting items
+#  'time travel': with only Time Travel
+# Each kind of search is kept from one validation to the next, as the items don't depend
+# on the entrances. Only what went through exits connected differently since is explored
+# again, along with what relied on that. The search returned is a copy, to query freely.
+def validation_search(kind, worlds, itempool=()):
+    worlds = tuple(worlds)
+    itempool = tuple(itempool)
+    connections = {exit: (exit.connected_region, exit.access_rule)
+                   for world in worlds for region in world.regions for exit in region.exits}
+    kept = validation_search.kept.get(kind)
+    if kept is None or kept['worlds'] != worlds or kept['itempool'] != itempool:
+        if kind == 'no items':
+            states = [State(world) for world in worlds]
+        else:
+            states = [world.state.copy() for world in worlds]
+        if kind == 'max':
+            for item in itempool:
+                states[item.world.id].collect(item)
+        elif kind == 'time travel':
+            for state in states:
+                state.collect(ItemFactory('Time Travel', world=state.world))
+        search = AssumedSearch(states)
+        kept = {
+            'worlds': worlds,
+            'itempool': itempool,
+            'search': search,
+            'item_locations': search.progression_locations() if kind == 'max' else None,
+        }
+        validation_search.kept[kind] = kept
+    else:
+        search = kept['search']
+        old_connections = kept['connections']
+        changed = {exit for exit, connection in old_connections.items() if connections.get(exit) != connection}
+        changed.update(exit for exit in connections if exit not in old_connections)
+        if changed:
+            search.reconnect(changed, {exit: old_connections[exit][0] for exit in changed if exit in old_connections})
+            if kind != 'max':
+                search.next_sphere()
+    kept['connections'] = connections
+    if kind == 'max':
+        search.collect_locations(kept['item_locations'])
+    return search.copy()
+
+# map kind -> the kept search, and what it was made from
+validation_search.kept = {}
+
+
 # Returns whether or not we can affirm the entrance can never be accessed as the given age
 def entrance_unreachable_as(entrance, age, already_checked=None):
     if already_checked == None:
@@ -1,12 +1,14 @@
 import random
 import logging
+from collections import Counter
 from State import State
 from Rules import set_shop_rules
 from Location import DisableType
 from LocationList import location_groups
 from ItemPool import song_list, get_junk_item, item_groups, remove_junk_items
 from Item import ItemFactory, ItemInfo
-from Search import Search
+from Search import Search, AssumedSearch
+from Profiler import profile_stage
 from functools import reduce
 
 logger = logging.getLogger('')
@@ -20,6 +22,65 @@ class FillError(ShuffleError):
     pass
 
 
+# Indexes which locations each kind of item may be placed in, reachability aside.
+# That only depends on the item's name and world, so the region restrictions and
+# item rules of a location are checked once for each kind rather than for each item,
+# and scans pass over the locations a kind can never go in.
+# Locations that are filled are never scanned again, so they need no removal.
+class FillIndex(object):
+    cache_stats = Counter()
+
+    def __init__(self):
+        # map (item name, world id) -> set of the locations that can take the item
+        self.fillable = {}
+        # map (item name, world id) -> set of the locations that can't
+        self.unfillable = {}
+
+
+    def _kind(self, item):
+        key = (item.name, item.world.id)
+        fillable = self.fillable.get(key)
+        if fillable is None:
+            fillable = self.fillable[key] = set()
+            self.unfillable[key] = set()
+            self.cache_stats['item_kinds'] += 1
+        return fillable, self.unfillable[key]
+
+
+    def can_fill_fast(self, location, item):
+        fillable, unfillable = self._kind(item)
+        if location in fillable:
+            self.cache_stats['rule_hits'] += 1
+            return True
+        if location in unfillable:
+            self.cache_stats['rule_hits'] += 1
+            return False
+        self.cache_stats['rule_checks'] += 1
+        if location.can_fill_fast(item):
+            fillable.add(location)
+            return True
+        unfillable.add(location)
+        return False
+
+
+    # Yields the locations, in order, that can take the item, reachability aside.
+    # Locations known not to take this kind of item are skipped without a lookup.
+    def candidates(self, locations, item):
+        fillable, unfillable = self._kind(item)
+        for location in locations:
+            if location in fillable:
+                yield location
+            elif location in unfillable:
+                self.cache_stats['locations_skipped'] += 1
+            elif self.can_fill_fast(location, item):
+                yield location
+
+
+    # Location.can_fill, with the item rules looked up in the index.
+    def can_fill(self, location, state, item, check_access=True):
+        return self.can_fill_fast(location, item) and location.can_fill_access(state, item, check_access)
+
+
 # Places all items into the world
 def distribute_items_restrictive(window, worlds, fill_locations=None):
     if worlds[0].settings.shuffle_song_items == 'song':
@@ -128,7 +189,8 @@ def distribute_items_restrictive(window, worlds, fill_locations=None):
     # or not. This shouldn't have much affect on item bias.
     if shop_locations:
         logger.info('Placing shop items.')
-        fill_ownworld_restrictive(window, worlds, search, shop_locations, shopitempool, itempool + songitempool + dungeon_items, "shop")
+        with profile_stage('shop items'):
+            fill_ownworld_restrictive(window, worlds, search, shop_locations, shopitempool, itempool + songitempool + dungeon_items, "shop")
     # Update the shop item access rules
     for world in worlds:
         set_shop_rules(world)
@@ -141,7 +203,8 @@ def distribute_items_restrictive(window, worlds, fill_locations=None):
     # placement, but will leave as is for now
     if dungeon_items:
         logger.info('Placing dungeon items.')
-        fill_dungeons_restrictive(window, worlds, search, fill_locations, dungeon_items, itempool + songitempool)
+        with profile_stage('dungeon items'):
+            fill_dungeons_restrictive(window, worlds, search, fill_locations, dungeon_items, itempool + songitempool)
         search.collect_locations()
 
     # places the songs into the world
@@ -152,7 +215,8 @@ def distribute_items_restrictive(window, worlds, fill_locations=None):
     # the song locations only.
     if worlds[0].settings.shuffle_song_items != 'any':
         logger.info('Placing song items.')
-        fill_ownworld_restrictive(window, worlds, search, song_locations, songitempool, progitempool, "song")
+        with profile_stage('song items'):
+            fill_ownworld_restrictive(window, worlds, search, song_locations, songitempool, progitempool, "song")
         search.collect_locations()
         fill_locations += [location for location in song_locations if location.item is None]
 
@@ -160,14 +224,16 @@ def distribute_items_restrictive(window, worlds, fill_locations=None):
     # placed to ensure there is a spot available for them
     if worlds[0].settings.one_item_per_dungeon:
         logger.info('Placing one major item per dungeon.')
-        fill_dungeon_unique_item(window, worlds, search, fill_locations, progitempool)
+        with profile_stage('one item per dungeon'):
+            fill_dungeon_unique_item(window, worlds, search, fill_locations, progitempool)
         search.collect_locations()
 
     # Place all progression items. This will include keys in keysanity.
     # Items in this group will check for reachability and will be placed
     # such that the game is guaranteed beatable.
     logger.info('Placing progression items.')
-    fill_restrictive(window, worlds, search, fill_locations, progitempool)
+    with profile_stage('progression items'):
+        fill_restrictive(window, worlds, search, fill_locations, progitempool)
     search.collect_locations()
 
     # Place all priority items.
@@ -175,13 +241,15 @@ def distribute_items_restrictive(window, worlds, fill_locations=None):
     # placed in the location, not checking reachability. This is important
     # for things like Ice Traps that can't be found at some locations
     logger.info('Placing priority items.')
-    fill_restrictive_fast(window, worlds, fill_locations, prioitempool)
+    with profile_stage('priority items'):
+        fill_restrictive_fast(window, worlds, fill_locations, prioitempool)
 
     # Place the rest of the items.
     # No restrictions at all. Places them completely randomly. Since they
     # cannot affect the beatability, we don't need to check them
     logger.info('Placing the rest of the items.')
-    fast_fill(window, fill_locations, restitempool)
+    with profile_stage('rest of the items'):
+        fast_fill(window, fill_locations, restitempool)
 
     # Log unplaced item/location warnings
     for item in progitempool + prioitempool + restitempool:
@@ -365,6 +433,13 @@ def fill_restrictive(window, worlds, base_search, locations, itempool, count=-1)
     items_search = base_search.copy()
     items_search.collect_all(itempool)
     logging.getLogger('').debug(f'Placing {len(itempool)} items among {len(locations)} potential locations.')
+    fill_index = FillIndex()
+
+    # Unless in compatibility mode, the max search is kept from one item to the next,
+    # and only the part of it that relied on the item to place is explored again.
+    incremental = not worlds[0].settings.fill_compatibility
+    if incremental:
+        max_search = AssumedSearch.from_search(items_search)
 
     # loop until there are no items or locations
     while itempool and locations:
@@ -382,8 +457,11 @@ def fill_restrictive(window, worlds, base_search, locations, itempool, count=-1)
 
         # generate the max search with every remaining item
         # this will allow us to place this item in a reachable location
-        items_search.uncollect(item_to_place)
-        max_search = items_search.copy()
+        if incremental:
+            max_search.uncollect(item_to_place)
+        else:
+            items_search.uncollect(item_to_place)
+            max_search = items_search.copy()
         max_search.collect_locations()
 
         # perform_access_check checks location reachability
@@ -403,8 +481,8 @@ def fill_restrictive(window, worlds, base_search, locations, itempool, count=-1)
         # find a location that the item can be placed. It must be a valid location
         # in the world we are placing it (possibly checking for reachability)
         spot_to_fill = None
-        for location in l2cations:
-            if location.can_fill(max_search.state_list[location.world.id], item_to_place, perform_access_check):
+        for location in fill_index.candidates(l2cations, item_to_place):
+            if location.can_fill_access(max_search.state_list[location.world.id], item_to_place, perform_access_check):
                 # for multiworld, make it so that the location is also reachable
                 # in the world the item is for. This is to prevent early restrictions
                 # in one world being placed late in another world. If this is not
@@ -412,7 +490,7 @@ def fill_restrictive(window, worlds, base_search, locations, itempool, count=-1)
                 if location.world.id != item_to_place.world.id:
                     try:
                         source_location = item_to_place.world.get_location(location.name)
-                        if not source_location.can_fill(max_search.state_list[item_to_place.world.id], item_to_place, perform_access_check):
+                        if not fill_index.can_fill(source_location, max_search.state_list[item_to_place.world.id], item_to_place, perform_access_check):
                             # location wasn't reachable in item's world, so skip it
                             continue
                     except KeyError:
@@ -445,7 +523,10 @@ def fill_restrictive(window, worlds, base_search, locations, itempool, count=-1)
             if count > 0:
                 # don't decrement count, we didn't place anything
                 unplaced_items.append(item_to_place)
-                items_search.collect(item_to_place)
+                if incremental:
+                    max_search.collect(item_to_place)
+                else:
+                    items_search.collect(item_to_place)
                 continue
             else:
                 # we expect all items to be placed
@@ -473,16 +554,13 @@ def fill_restrictive(window, worlds, base_search, locations, itempool, count=-1)
 # It does not check for reachability, only that the item is
 # allowed in the location
 def fill_restrictive_fast(window, worlds, locations, itempool):
+    fill_index = FillIndex()
     while itempool and locations:
         item_to_place = itempool.pop()
         random.shuffle(locations)
 
         # get location that allows this item
-        spot_to_fill = None
-        for location in locations:
-            if location.can_fill_fast(item_to_place):
-                spot_to_fill = location
-                break
+        spot_to_fill = next(fill_index.candidates(locations, item_to_place), None)
 
         # if we failed to find a suitable location, then stop placing items
         # we don't need to check beatability since world must be beatable
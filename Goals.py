@@ -2,7 +2,7 @@ from collections import OrderedDict, defaultdict
 import logging
 
 from HintList import goalTable, getHintGroup, hintExclusions
-from Search import Search
+from Search import Search, AssumedSearch
 from Language import getLang
 
 validColors = [
@@ -306,14 +306,22 @@ def search_goals(categories, reachable_goals, search, priority_locations, all_lo
     world_ids = [state.world.id for state in search.state_list]
     if search_woth:
         required_locations['way of the hero'] = []
+    # Every progression item reachable from the start. Each location is checked on a copy
+    # that drops its item and what relied on it, then collects what is still reachable.
+    # This reaches the same items as searching on from the current sphere without it.
+    # The other items collected so far are added as they are, since goals can count them.
+    max_search = AssumedSearch.from_search(search)
+    progression_locations = max_search.progression_locations()
+    max_search.collect_locations(progression_locations)
     for location in search.iter_reachable_locations(all_locations):
         # Try to remove items one at a time and see if the goal is still reachable
         if location in item_locations:
             old_item = location.item
             location.item = None
-            # copies state! This is very important as we're in the middle of a search
-            # already, but beneficially, has search it can start from
-            valid_goals = search.beatable_goals(categories)
+            goal_search = max_search.fork()
+            goal_search.uncollect_location(location, old_item)
+            goal_search.collect_locations(progression_locations)
+            valid_goals = goal_search.beatable_goals_fast(categories)
             for cat_name, category in categories.items():
                 # Exit early if no goals are beatable with category locks
                 if category.name in reachable_goals and reachable_goals[category.name]:
@@ -348,6 +356,8 @@ def search_goals(categories, reachable_goals, search, priority_locations, all_lo
             location.item = old_item
             _maybe_set_light_arrows(location)
         search.state_list[location.item.world.id].collect(location.item)
+        if not location.item.advancement:
+            max_search.collect(location.item)
     return required_locations
 
 
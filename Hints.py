@@ -243,6 +243,8 @@ def add_hint(spoiler, world, groups, gossip_text, count, location=None, force_re
                         # This mostly guarantees that we don't lock the player out of an item hint
                         # by establishing a (hint -> item) -> hint -> item -> (first hint) loop
                         location.add_rule(world.parser.parse_rule(repr(event_item.name)))
+                        # The events and the rule change what can be reached.
+                        can_reach_hint.searches.clear()
 
                     total -= 1
                     first = False
@@ -287,22 +289,49 @@ def add_hint(spoiler, world, groups, gossip_text, count, location=None, force_re
             # Failure
             success = False
             break
+    # The location's hint is placed, so its search won't be asked about again.
+    can_reach_hint.searches.pop(location, None)
     groups.extend(duplicates)
     groups.extend(skipped_groups)
     return success
 
 
+# The search without the item of each location is kept until add_hint places events or
+# the location's hint, and only explored until the hint can be reached, since items only
+# add to what can be. At most max_searches are kept, dropping the oldest first.
 def can_reach_hint(worlds, hint_location, location):
     if location == None:
         return True
 
+    def reached():
+        return (search.spot_access(hint_location)
+                and (hint_location.type != 'HintStone' or search.state_list[location.world.id].guarantee_hint()))
+
     old_item = location.item
     location.item = None
-    search = Search.max_explore([world.state for world in worlds])
+    if location not in can_reach_hint.searches:
+        if len(can_reach_hint.searches) >= can_reach_hint.max_searches:
+            del can_reach_hint.searches[next(iter(can_reach_hint.searches))]
+        search = Search([world.state for world in worlds])
+        can_reach_hint.searches[location] = (search, search.progression_locations())
+    search, item_locations = can_reach_hint.searches[location]
+    reachable = reached()
+    if not reachable:
+        for found in search.iter_reachable_locations(item_locations):
+            search.collect(found.item)
+            reachable = reached()
+            if reachable:
+                break
+        else:
+            # every reachable item was collected
+            reachable = reached()
     location.item = old_item
 
-    return (search.spot_access(hint_location)
-            and (hint_location.type != 'HintStone' or search.state_list[location.world.id].guarantee_hint()))
+    return reachable
+
+# map location -> (search without its item, locations to collect), oldest first
+can_reach_hint.searches = {}
+can_reach_hint.max_searches = 4
 
 
 def writeGossipStoneHints(spoiler, world, messages):
@@ -1246,6 +1275,7 @@ def buildBingoHintList(boardURL):
 
 
 def buildGossipHints(spoiler, worlds):
+    can_reach_hint.searches.clear()
     checkedLocations = dict()
     # Add Light Arrow locations to "checked" locations if Ganondorf is reachable without it.
     for world in worlds:
@@ -1257,11 +1287,13 @@ def buildGossipHints(spoiler, worlds):
             if light_arrow_world.id not in checkedLocations:
                 checkedLocations[light_arrow_world.id] = set()
             checkedLocations[light_arrow_world.id].add(location.name)
+        can_reach_hint.searches.pop(location, None)
 
     # Build all the hints.
     for world in worlds:
         world.update_useless_areas(spoiler)
         buildWorldGossipHints(spoiler, world, checkedLocations.pop(world.id, None))
+    can_reach_hint.searches.clear()
 
 
 # builds out general hints based on location and whether an item is required or not
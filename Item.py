@@ -8,6 +8,9 @@ class ItemInfo(object):
     medallions = set()
     stones = set()
     junk = {}
+    # Dense integer ids for item and event names, used to index State.prog_items.
+    item_ids = {}
+    item_names = []
 
     def __init__(self, name='', event=False):
         if event:
@@ -30,6 +33,21 @@ class ItemInfo(object):
         self.stone = self.special.get('stone', False)
         self.alias = self.special.get('alias', None)
         self.junk = self.special.get('junk', None)
+        self.id = ItemInfo.get_id(name)
+        self.alias_id = ItemInfo.get_id(self.alias[0]) if self.alias else None
+
+
+    # Interns an item or event name, assigning it the next free id on first use.
+    # Ids are only stable within a single process.
+    @staticmethod
+    def get_id(name):
+        try:
+            return ItemInfo.item_ids[name]
+        except KeyError:
+            item_id = len(ItemInfo.item_names)
+            ItemInfo.item_ids[name] = item_id
+            ItemInfo.item_names.append(name)
+            return item_id
 
 
 for item_name in item_table:
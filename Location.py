@@ -1,5 +1,5 @@
 from LocationList import location_table, location_is_viewable
-from Region import TimeOfDay
+from Region import TimeOfDay, all_rules, no_rule
 from enum import Enum
 from itertools import chain
 
@@ -19,9 +19,17 @@ class Location(object):
         self.scene = scene
         self.internal = internal
         self.staleness_count = 0
-        self.access_rule = lambda state, **kwargs: True
+        self.access_rule = no_rule
         self.access_rules = []
         self.item_rule = lambda location, item: True
+        # The constraints item_rule is compiled from, see Rules.compile_item_rule.
+        # They are immutable, as locations cloned from a template share them.
+        self.forbidden_items = frozenset()
+        self.allowed_items = None
+        self.forbidden_item_types = frozenset()
+        self.allowed_item_types = None
+        self.own_world_items = False
+        self.item_rules = ()
         self.locked = False
         self.price = None
         self.minor_only = False
@@ -29,6 +37,8 @@ class Location(object):
         self.disabled = DisableType.ENABLED
         self.always = False
         self.never = False
+        # Dense index among the locations of all worlds, see World.index_spots
+        self.index = None
         if filter_tags is None:
             self.filter_tags = None
         else:
@@ -44,12 +54,19 @@ class Location(object):
         new_location.access_rule = self.access_rule
         new_location.access_rules = list(self.access_rules)
         new_location.item_rule = self.item_rule
+        new_location.forbidden_items = self.forbidden_items
+        new_location.allowed_items = self.allowed_items
+        new_location.forbidden_item_types = self.forbidden_item_types
+        new_location.allowed_item_types = self.allowed_item_types
+        new_location.own_world_items = self.own_world_items
+        new_location.item_rules = self.item_rules
         new_location.locked = self.locked
         new_location.internal = self.internal
         new_location.minor_only = self.minor_only
         new_location.disabled = self.disabled
         new_location.always = self.always
         new_location.never = self.never
+        new_location.index = self.index
 
         return new_location
 
@@ -67,7 +84,7 @@ class Location(object):
         if self.never:
             return
         self.access_rules.append(lambda_rule)
-        self.access_rule = lambda state, **kwargs: all(rule(state, **kwargs) for rule in self.access_rules)
+        self.access_rule = all_rules(self.access_rules)
 
 
     def set_rule(self, lambda_rule):
@@ -76,11 +93,15 @@ class Location(object):
 
 
     def can_fill(self, state, item, check_access=True):
+        return self.can_fill_fast(item) and self.can_fill_access(state, item, check_access)
+
+
+    # The checks of can_fill other than the item rules of can_fill_fast.
+    def can_fill_access(self, state, item, check_access=True):
         if self.minor_only and item.majoritem:
             return False
         return (
             not self.is_disabled() and
-            self.can_fill_fast(item) and
             (not check_access or state.search.spot_access(self, 'either'))
         )
 
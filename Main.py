@@ -3,7 +3,9 @@ import copy
 import hashlib
 import io
 import itertools
+import json
 import logging
+import multiprocessing
 import os, os.path
 import platform
 import random
@@ -26,15 +28,17 @@ from Item import Item
 from ItemPool import generate_itempool
 from Hints import buildGossipHints
 from HintList import clearHintExclusionCache
-from Utils import default_output_path, is_bundled, subprocess_args, data_path
+from Utils import default_output_path, is_bundled, subprocess_args, data_path, read_json
 from N64Patch import create_patch_file, apply_patch_file
 from SettingsList import setting_infos, logic_tricks
 from Rules import set_rules, set_shop_rules
 from Plandomizer import Distribution
+from RuleParser import Rule_AST_Transformer
 from Search import Search, RewindableSearch
 from EntranceShuffle import set_entrances
 from LocationList import set_drop_location_names
 from Goals import update_goal_items, maybe_set_light_arrows, replace_goal_names
+from Profiler import StageProfile, profile_stage
 from version import __version__
 
 
@@ -47,14 +51,34 @@ class dummy_window():
         pass
 
 
-def main(settings, window=dummy_window(), max_attempts=10):
+def main(settings, window=dummy_window(), max_attempts=10, rom=None):
     clearHintExclusionCache()
     logger = logging.getLogger('')
     start = time.process_time()
+    profile_stage.profile = StageProfile() if settings.profile_stages else None
 
-    rom = resolve_settings(settings, window=window)
+    with profile_stage('resolve_settings'):
+        rom = resolve_settings(settings, window=window, rom=rom)
 
     max_attempts = max(max_attempts, 1)
+    if settings.attempt_workers > 1 and max_attempts > 1:
+        spoiler = generate_in_parallel(settings, window, max_attempts)
+    else:
+        spoiler = generate_in_series(settings, window, max_attempts)
+    with profile_stage('patch_and_output'):
+        patch_and_output(settings, window, spoiler, rom)
+
+    if profile_stage.profile is not None:
+        profile_path = os.path.join(default_output_path(settings.output_dir), '%s_Profile.json' % get_output_filename_base(settings))
+        profile_stage.profile.to_file(profile_path)
+        profile_stage.profile = None
+        logger.info("Created stage profile at: %s" % profile_path)
+    logger.debug('Total Time: %s', time.process_time() - start)
+    return spoiler
+
+
+def generate_in_series(settings, window, max_attempts):
+    logger = logging.getLogger('')
     spoiler = None
     for attempt in range(1, max_attempts + 1):
         try:
@@ -67,13 +91,137 @@ def main(settings, window=dummy_window(), max_attempts=10):
             else:
                 logger.info('Retrying...\n\n')
             settings.reset_distribution()
-    patch_and_output(settings, window, spoiler, rom)
-    logger.debug('Total Time: %s', time.process_time() - start)
     return spoiler
 
 
-def resolve_settings(settings, window=dummy_window()):
+# The first attempt runs here with the random state left by resolve_settings, exactly as
+# in series. Meanwhile the other attempts run in worker processes, each seeded from the
+# seed and its attempt number. The lowest numbered attempt that succeeds is used, so the
+# result doesn't depend on which worker finishes first, or on how many workers there are.
+# It is the same as in series only when the first attempt succeeds, since the attempts
+# after it there continue from the random state it left.
+# Spoilers can't be sent between processes, so a successful attempt from a worker is
+# generated again here from its seed. If that fails here, the next successful one is used.
+def generate_in_parallel(settings, window, max_attempts):
     logger = logging.getLogger('')
+    ctx = multiprocessing.get_context('spawn')
+    # The pool sends the settings to the workers in the background, while the first
+    # attempt is changing them, so the workers are given a copy from before it.
+    worker_settings = copy.deepcopy(settings)
+    with ctx.Pool(min(settings.attempt_workers - 1, max_attempts - 1)) as pool:
+        results = {attempt: pool.apply_async(generate_attempt, (worker_settings, attempt))
+                   for attempt in range(2, max_attempts + 1)}
+        try:
+            return generate(settings, window=window)
+        except ShuffleError as e:
+            logger.warning('Failed attempt %d of %d: %s', 1, max_attempts, e)
+            error = e
+
+        for attempt, result in results.items():
+            error = result.get()
+            if error is None:
+                logger.info('Using attempt %d of %d.', attempt, max_attempts)
+                settings.reset_distribution()
+                random.seed(attempt_seed(settings, attempt))
+                try:
+                    return generate(settings, window=window)
+                except ShuffleError as e:
+                    error = e
+            logger.warning('Failed attempt %d of %d: %s', attempt, max_attempts, error)
+    # Leaving the pool stops the attempts still running. As in series, the error
+    # of the last attempt is raised.
+    raise error
+
+
+def attempt_seed(settings, attempt):
+    return '%d-%d' % (settings.numeric_seed, attempt)
+
+
+# Runs in a worker process. Returns None on success, or else the error the attempt failed with.
+def generate_attempt(settings, attempt):
+    # Pool workers can't start workers of their own.
+    settings.playthrough_workers = 1
+    settings.reset_distribution()
+    random.seed(attempt_seed(settings, attempt))
+    try:
+        generate(settings)
+    except ShuffleError as e:
+        return e
+    return None
+
+
+# Generates settings.count seeds, named <seed>-<i> as in series, in a pool of
+# settings.batch_workers processes. The ROM and the logic caches are loaded here
+# first, so that forked workers start with them. Where processes can't be forked,
+# each worker loads its own once, when it starts. Returns a summary of each seed,
+# in order, which is also written to a batch report in the output directory.
+def main_batch(settings, max_attempts=10):
+    logger = logging.getLogger('')
+    start = time.perf_counter()
+
+    warm_settings = copy.deepcopy(settings)
+    rom = resolve_settings(warm_settings)
+    build_world_graphs(warm_settings)
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('fork')
+        initargs = (rom, None)
+    else:
+        ctx = multiprocessing.get_context('spawn')
+        initargs = (None, warm_settings.rom if rom is not None else None)
+    results = []
+    with ctx.Pool(settings.batch_workers, initializer=init_batch_worker, initargs=initargs) as pool:
+        for result in pool.imap(generate_batch_seed, [(settings, index, max_attempts) for index in range(settings.count)]):
+            if result['error'] is None:
+                logger.info('Seed %s generated in %.2f seconds.', result['seed'], result['seconds'])
+            else:
+                logger.error('Seed %s failed after %.2f seconds: %s', result['seed'], result['seconds'], result['error'])
+            results.append(result)
+
+    failures = sum(1 for result in results if result['error'] is not None)
+    logger.info('Generated %d of %d seeds in %.2f seconds.', len(results) - failures, len(results), time.perf_counter() - start)
+    report_path = os.path.join(default_output_path(settings.output_dir), 'OoT_%s_Batch.json' % settings.seed)
+    with open(report_path, 'w') as f:
+        json.dump(results, f, indent=4)
+    logger.info('Created batch report at: %s' % report_path)
+    return results
+
+
+# Runs in each worker process as it starts, given either the ROM or the path to load it from.
+def init_batch_worker(rom, rom_path):
+    if rom is None and rom_path is not None:
+        rom = Rom(rom_path)
+    generate_batch_seed.rom = rom
+
+
+# Runs in a worker process. The returned summary has the seed, the time it took,
+# the spoiler log path if one was written, and the error if the seed failed.
+def generate_batch_seed(args):
+    settings, index, max_attempts = args
+    settings.update_seed('%s-%d' % (settings.seed, index))
+    # Pool workers can't start workers of their own.
+    settings.attempt_workers = 1
+    settings.playthrough_workers = 1
+    start = time.perf_counter()
+    result = {'seed': settings.seed, 'spoiler': None, 'error': None}
+    try:
+        main(settings, max_attempts=max_attempts, rom=generate_batch_seed.rom)
+        if settings.create_spoiler:
+            result['spoiler'] = os.path.join(default_output_path(settings.output_dir), '%s_Spoiler.json' % get_output_filename_base(settings))
+    except Exception as e:
+        logging.getLogger('').exception(e)
+        result['error'] = str(e)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+generate_batch_seed.rom = None
+
+
+def resolve_settings(settings, window=dummy_window(), rom=None):
+    logger = logging.getLogger('')
+
+    # parsed data files are cached alongside the parsed logic files
+    read_json.cache_dir = os.path.join(default_output_path(settings.output_dir), 'Cache') if settings.logic_cache else None
 
     old_tricks = settings.allowed_tricks
     settings.load_distribution()
@@ -92,11 +240,14 @@ def resolve_settings(settings, window=dummy_window()):
     if not (using_rom or settings.patch_without_output) and not settings.create_spoiler:
         raise Exception('You must have at least one output type or spoiler log enabled to produce anything.')
 
-    if using_rom:
+    if not using_rom:
+        rom = None
+    elif rom is None:
         window.update_status('Loading ROM')
         rom = Rom(settings.rom)
     else:
-        rom = None
+        # a ROM loaded for an earlier seed
+        rom.restore()
 
     if not settings.world_count:
         settings.world_count = 1
@@ -124,14 +275,19 @@ def resolve_settings(settings, window=dummy_window()):
     return rom
 
 
+# Each attempt is profiled as a stage of its own, see Profiler.
+@profile_stage('generate')
 def generate(settings, window=dummy_window()):
-    worlds = build_world_graphs(settings, window=window)
-    place_items(settings, worlds, window=window)
+    with profile_stage('build_world_graphs'):
+        worlds = build_world_graphs(settings, window=window)
+    with profile_stage('place_items'):
+        place_items(settings, worlds, window=window)
     for world in worlds:
         world.distribution.configure_effective_starting_items(worlds, world)
     if worlds[0].enable_goal_hints:
         replace_goal_names(worlds)
-    return make_spoiler(settings, worlds, window=window)
+    with profile_stage('make_spoiler'):
+        return make_spoiler(settings, worlds, window=window)
 
 
 def build_world_graphs(settings, window=dummy_window()):
@@ -143,40 +299,53 @@ def build_world_graphs(settings, window=dummy_window()):
     window.update_status('Creating the Worlds')
     for id, world in enumerate(worlds):
         logger.info('Generating World %d.' % (id + 1))
+        with profile_stage('world %d' % (id + 1)):
+            window.update_progress(0 + 1*(id + 1)/settings.world_count)
+            logger.info('Creating Overworld')
 
-        window.update_progress(0 + 1*(id + 1)/settings.world_count)
-        logger.info('Creating Overworld')
-
-        if settings.logic_rules == 'glitched':
-            overworld_data = os.path.join(data_path('Glitched World'), 'Overworld.json')
-        else:
-            overworld_data = os.path.join(data_path('World'), 'Overworld.json')
-
-        # Compile the json rules based on settings
-        world.load_regions_from_json(overworld_data)
-        create_dungeons(world)
-        world.create_internal_locations()
-
-        if settings.shopsanity != 'off':
-            world.random_shop_prices()
-        world.set_scrub_prices()
-
-        window.update_progress(0 + 4*(id + 1)/settings.world_count)
-        logger.info('Calculating Access Rules.')
-        set_rules(world)
+            if settings.logic_rules == 'glitched':
+                overworld_data = os.path.join(data_path('Glitched World'), 'Overworld.json')
+            else:
+                overworld_data = os.path.join(data_path('World'), 'Overworld.json')
+
+            # Compile the json rules based on settings
+            with profile_stage('load_regions'):
+                world.load_regions_from_json(overworld_data)
+                create_dungeons(world)
+                world.create_internal_locations()
+
+            if settings.shopsanity != 'off':
+                world.random_shop_prices()
+            world.set_scrub_prices()
+
+            window.update_progress(0 + 4*(id + 1)/settings.world_count)
+            logger.info('Calculating Access Rules.')
+            with profile_stage('set_rules'):
+                set_rules(world)
+
+            window.update_progress(0 + 5*(id + 1)/settings.world_count)
+            logger.info('Generating Item Pool.')
+            with profile_stage('generate_itempool'):
+                generate_itempool(world)
+                set_shop_rules(world)
+                set_drop_location_names(world)
+                world.fill_bosses()
+
+    region_index, location_index = 0, 0
+    for world in worlds:
+        region_index, location_index = world.index_spots(region_index, location_index)
 
-        window.update_progress(0 + 5*(id + 1)/settings.world_count)
-        logger.info('Generating Item Pool.')
-        generate_itempool(world)
-        set_shop_rules(world)
-        set_drop_location_names(world)
-        world.fill_bosses()
+    cache_stats = Rule_AST_Transformer.cache_stats
+    logger.debug('Logic files parsed: %d, reused: %d. Rules compiled: %d, reused: %d.',
+                 cache_stats['files_parsed'], cache_stats['files_shared'] + cache_stats['files_loaded'],
+                 cache_stats['rules_compiled'], cache_stats['rules_shared'] + cache_stats['rules_loaded'])
 
     if settings.triforce_hunt:
         settings.distribution.configure_triforce_hunt(worlds)
 
     logger.info('Setting Entrances.')
-    set_entrances(worlds)
+    with profile_stage('set_entrances'):
+        set_entrances(worlds)
     return worlds
 
 
@@ -194,13 +363,16 @@ def make_spoiler(settings, worlds, window=dummy_window()):
     if settings.create_spoiler:
         window.update_status('Calculating Spoiler Data')
         logger.info('Calculating playthrough.')
-        create_playthrough(spoiler)
+        with profile_stage('create_playthrough'):
+            create_playthrough(spoiler)
         window.update_progress(50)
     if settings.create_spoiler or settings.hints != 'none':
         window.update_status('Calculating Hint Data')
         logger.info('Calculating hint data.')
-        update_goal_items(spoiler)
-        buildGossipHints(spoiler, worlds)
+        with profile_stage('update_goal_items'):
+            update_goal_items(spoiler)
+        with profile_stage('buildGossipHints'):
+            buildGossipHints(spoiler, worlds)
         window.update_progress(55)
     elif settings.misc_hints:
         # Ganon may still provide the Light Arrows hint
@@ -214,8 +386,10 @@ def prepare_rom(spoiler, world, rom, settings, rng_state=None, restore=True):
         rom.restore()
     if rng_state:
         random.setstate(rng_state)
-    patch_rom(spoiler, world, rom)
-    cosmetics_log = patch_cosmetics(settings, rom)
+    with profile_stage('patch_rom'):
+        patch_rom(spoiler, world, rom)
+    with profile_stage('patch_cosmetics'):
+        cosmetics_log = patch_cosmetics(settings, rom)
     rom.update_header()
     return cosmetics_log
 
@@ -294,19 +468,22 @@ def generate_wad(wad_file, rom_file, output_file, channel_title, channel_id, win
         os.remove(rom_file)
 
 
+def get_output_filename_base(settings):
+    if settings.output_file:
+        return settings.output_file
+    settings_string_hash = hashlib.sha1(settings.settings_string.encode('utf-8')).hexdigest().upper()[:5]
+    output_filename_base = f"OoT_{settings_string_hash}_{settings.seed}"
+    if settings.world_count > 1:
+        output_filename_base += f"_W{settings.world_count}"
+    return output_filename_base
+
+
 def patch_and_output(settings, window, spoiler, rom):
     logger = logging.getLogger('')
     worlds = spoiler.worlds
     cosmetics_log = None
 
-    settings_string_hash = hashlib.sha1(settings.settings_string.encode('utf-8')).hexdigest().upper()[:5]
-    if settings.output_file:
-        output_filename_base = settings.output_file
-    else:
-        output_filename_base = f"OoT_{settings_string_hash}_{settings.seed}"
-        if settings.world_count > 1:
-            output_filename_base += f"_W{settings.world_count}"
-
+    output_filename_base = get_output_filename_base(settings)
     output_dir = default_output_path(settings.output_dir)
 
     compressed_rom = settings.create_compressed_rom or settings.create_wad_file
@@ -341,7 +518,8 @@ def patch_and_output(settings, window, spoiler, rom):
                 log_and_update_window(window, f"Creating Patch File: {patch_filename}")
                 output_path = os.path.join(output_dir, patch_filename)
                 file_list.append(patch_filename)
-                create_patch_file(rom, output_path)
+                with profile_stage('create_patch_file'):
+                    create_patch_file(rom, output_path)
                 window.update_progress(65 + 30*(world.id + 1)/settings.world_count)
 
                 # Cosmetics Log for patch file only.
@@ -366,7 +544,8 @@ def patch_and_output(settings, window, spoiler, rom):
                 cosmetics_log = prepare_rom(spoiler, world, rom, settings, rng_state, restore_rom)
             else:
                 cosmetics_log = patch_cosmetics_log
-            rom.write_to_file(uncompressed_path)
+            with profile_stage('write_rom'):
+                rom.write_to_file(uncompressed_path)
             logger.info("Created uncompressed ROM at: %s" % uncompressed_path)
 
             # If we aren't compressing the ROM, we're done with this world.
@@ -376,7 +555,8 @@ def patch_and_output(settings, window, spoiler, rom):
             compressed_filename = f"{output_filename_base}{player_filename_suffix}.z64"
             compressed_path = os.path.join(output_dir, compressed_filename)
             log_and_update_window(window, f"Compressing ROM: {compressed_filename}")
-            compress_rom(uncompressed_path, compressed_path, window, not settings.create_uncompressed_rom)
+            with profile_stage('compress_rom'):
+                compress_rom(uncompressed_path, compressed_path, window, not settings.create_uncompressed_rom)
             logger.info("Created compressed ROM at: %s" % compressed_path)
 
             # If we aren't generating a WAD, we're done with this world.
@@ -388,7 +568,8 @@ def patch_and_output(settings, window, spoiler, rom):
             log_and_update_window(window, f"Generating WAD file: {wad_filename}")
             channel_title = settings.wad_channel_title if settings.wad_channel_title != "" and settings.wad_channel_title is not None else "OoTRandomizer"
             channel_id = settings.wad_channel_id if settings.wad_channel_id != "" and settings.wad_channel_id is not None else "OOTE"
-            generate_wad(settings.wad_file, compressed_path, wad_path, channel_title, channel_id, window, not settings.create_compressed_rom)
+            with profile_stage('generate_wad'):
+                generate_wad(settings.wad_file, compressed_path, wad_path, channel_title, channel_id, window, not settings.create_compressed_rom)
             logger.info("Created WAD file at: %s" % wad_path)
 
         # World loop over, make the patch archive if applicable.
@@ -396,7 +577,7 @@ def patch_and_output(settings, window, spoiler, rom):
             patch_archive_filename = f"{output_filename_base}.zpfz"
             patch_archive_path = os.path.join(output_dir, patch_archive_filename)
             log_and_update_window(window, f"Creating Patch Archive: {patch_archive_filename}")
-            with zipfile.ZipFile(patch_archive_path, mode="w") as patch_archive:
+            with profile_stage('create_patch_archive'), zipfile.ZipFile(patch_archive_path, mode="w") as patch_archive:
                 for file in file_list:
                     file_path = os.path.join(output_dir, file)
                     patch_archive.write(file_path, file.replace(output_filename_base, '').replace('.zpf_Cosmetics', '_Cosmetics'), compress_type=zipfile.ZIP_DEFLATED)
@@ -416,7 +597,8 @@ def patch_and_output(settings, window, spoiler, rom):
         settings.distribution.update_spoiler(spoiler, True)
         window.update_status('Creating Spoiler Log')
         spoiler_path = os.path.join(output_dir, '%s_Spoiler.json' % output_filename_base)
-        settings.distribution.to_file(spoiler_path, True)
+        with profile_stage('write_spoiler'):
+            settings.distribution.to_file(spoiler_path, True)
         logger.info("Created spoiler log at: %s" % ('%s_Spoiler.json' % output_filename_base))
 
     if settings.create_cosmetics_log and cosmetics_log:
@@ -564,7 +746,7 @@ def cosmetic_patch(settings, window=dummy_window()):
 
     # clear changes from the base patch file
     patched_base_rom = copy.copy(rom.buffer)
-    rom.changed_address = {}
+    rom.changed_ranges = []
     rom.changed_dma = {}
     rom.force_patch = []
 
@@ -685,6 +867,11 @@ def create_playthrough(spoiler):
     # Reduce each sphere in reverse order, by checking if the game is beatable
     # when we remove the item. We do this to make sure that progressive items
     # like bow and slingshot appear as early as possible rather than as late as possible.
+    # With several workers, the checks are made in worker processes beforehand.
+    workers = worlds[0].settings.playthrough_workers
+    in_parallel = workers > 1 and 'fork' in multiprocessing.get_all_start_methods()
+    if in_parallel:
+        location_checks = find_required_locations(search, collection_spheres, workers)
     required_locations = []
     for sphere in reversed(collection_spheres):
         for location in sphere:
@@ -708,27 +895,37 @@ def create_playthrough(spoiler):
             if search.state_list[old_item.world.id].item_count(old_item.name) < old_item.world.max_progressions[old_item.name]:
                 # Test whether the game is still beatable from here.
                 logger.debug('Checking if %s is required to beat the game.', old_item.name)
-                if not search.can_beat_game():
+                if location_checks[location] if in_parallel else not search.can_beat_game():
                     # still required, so reset the item
                     location.item = old_item
                     required_locations.append(location)
 
     # Reduce each entrance sphere in reverse order, by checking if the game is beatable when we disconnect the entrance.
+    # Each check resumes a search of the required items from before any of the
+    # disconnected entrances could be used.
+    entrances = [entrance for sphere in reversed(entrance_spheres) for entrance in sphere]
+    if entrances:
+        entrance_search = explore_for_entrance_checks(worlds, entrances)
+    if in_parallel and entrances:
+        entrance_checks = find_required_entrances(entrance_search, entrances, workers)
     required_entrances = []
-    for sphere in reversed(entrance_spheres):
-        for entrance in sphere:
-            # we disconnect the entrance and check if the game is still beatable
-            old_connected_region = entrance.disconnect()
-
-            # we use a new search to ensure the disconnected entrance is no longer used
-            sub_search = Search([world.state for world in worlds])
-
-            # Test whether the game is still beatable from here.
-            logger.debug('Checking if reaching %s, through %s, is required to beat the game.', old_connected_region.name, entrance.name)
-            if not sub_search.can_beat_game():
-                # still required, so reconnect the entrance
-                entrance.connect(old_connected_region)
-                required_entrances.append(entrance)
+    disconnected_entrances = []
+    for entrance in entrances:
+        # we disconnect the entrance and check if the game is still beatable
+        old_connected_region = entrance.disconnect()
+        disconnected_entrances.append(entrance)
+
+        # Test whether the game is still beatable from here.
+        logger.debug('Checking if reaching %s, through %s, is required to beat the game.', old_connected_region.name, entrance.name)
+        if in_parallel:
+            required = entrance_checks[entrance]
+        else:
+            required = not can_beat_game_without_entrances(entrance_search, disconnected_entrances)
+        if required:
+            # still required, so reconnect the entrance
+            entrance.connect(old_connected_region)
+            required_entrances.append(entrance)
+            disconnected_entrances.pop()
 
     # Regenerate the spheres as we might not reach places the same way anymore.
     search.reset() # search state has no items, okay to reuse sphere 0 cache
@@ -770,3 +967,151 @@ def create_playthrough(spoiler):
 
     if worlds[0].entrance_shuffle:
         spoiler.entrance_playthrough = OrderedDict((str(i + 1), list(sphere)) for i, sphere in enumerate(entrance_spheres))
+
+
+# Explores the worlds sphere by sphere with every entrance connected, collecting the
+# items at the locations that still have them, and checkpointing each sphere. Returns
+# the search, the locations found in each sphere, and for each of the entrances the
+# index of the last sphere cache reached without going through it, or -1 if none was.
+def explore_for_entrance_checks(worlds, entrances):
+    search = RewindableSearch([world.state for world in worlds])
+    item_locations = search.progression_locations()
+    spheres = []
+    last_spheres = {}
+    remaining_entrances = set(entrances)
+    while True:
+        search.checkpoint()
+        collected = list(search.iter_reachable_locations(item_locations))
+        # The first sphere cache includes the regions of the first sphere.
+        accessed_entrances = set(filter(search.spot_access, remaining_entrances))
+        for entrance in accessed_entrances:
+            last_spheres[entrance] = len(spheres) if spheres else -1
+        remaining_entrances -= accessed_entrances
+        if not collected:
+            break
+        spheres.append(collected)
+        for location in collected:
+            search.collect(location.item)
+    for entrance in remaining_entrances:
+        last_spheres[entrance] = len(search.cached_spheres) - 1
+    return search, spheres, last_spheres
+
+
+# Returns whether the game can still be beaten with the given entrances disconnected.
+# This is the same as a new search, but resumes from the last sphere explored without any
+# of them, with the items found before it. The exits that failed there are tried again.
+def can_beat_game_without_entrances(entrance_search, disconnected):
+    search, spheres, last_spheres = entrance_search
+    index = min(last_spheres[entrance] for entrance in disconnected)
+    if index < 0:
+        return Search([state.world.state for state in search.state_list]).can_beat_game()
+    states = [state.world.state.copy() for state in search.state_list]
+    for location in itertools.chain.from_iterable(spheres[:index]):
+        states[location.item.world.id].collect(location.item)
+    return search.search_from_sphere(index, states).can_beat_game()
+
+
+# Makes the checks of create_playthrough in a pool of forked worker processes, which start
+# with the worlds as they are now. In series, each candidate is removed on top of the earlier
+# candidates found not to be required. So the checks of a batch are made assuming the earlier
+# candidates in it aren't required: the results hold up to the first one found required,
+# and the checks after it are made again. The result is the same as in series.
+# Candidates that aren't checked are never required. check is called with the index of
+# a candidate and the indices of the earlier candidates to remove, and returns whether
+# the game can't be beaten without them. Returns whether each candidate is required.
+def run_required_checks(check, candidates, checked, workers):
+    required = [False] * len(candidates)
+    pending = [index for index in range(len(candidates)) if checked[index]]
+    checks, batches = 0, 0
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(workers) as pool:
+        while pending:
+            batch = pending[:workers]
+            tasks = [(index, [earlier for earlier in range(index) if not required[earlier]]) for index in batch]
+            checks += len(tasks)
+            batches += 1
+            for index, result in zip(batch, pool.map(check, tasks)):
+                pending.remove(index)
+                required[index] = result
+                if result:
+                    break
+    logging.getLogger('').debug('Made %d checks in %d batches for %d candidates.', checks, batches, sum(checked))
+    return dict(zip(candidates, required))
+
+
+# Returns whether the game can't be beaten without each location that create_playthrough
+# checks, given its search after building up the collection spheres.
+def find_required_locations(search, collection_spheres, workers):
+    # The locations are checked in reverse sphere order, each with the items of the
+    # earlier spheres and of the locations after it in its sphere. Internal locations
+    # are always required, and other locations are only checked if the item could be.
+    states = [state.copy() for state in search.state_list]
+    candidates = []
+    positions = []
+    checked = []
+    for sphere_index in reversed(range(len(collection_spheres))):
+        for position, location in enumerate(collection_spheres[sphere_index]):
+            item = location.item
+            states[item.world.id].remove(item)
+            if location.internal:
+                continue
+            candidates.append(location)
+            positions.append((sphere_index, position))
+            checked.append(states[item.world.id].item_count(item.name) < item.world.max_progressions[item.name])
+    check_required_location.context = (search, collection_spheres, candidates, positions)
+    try:
+        return run_required_checks(check_required_location, candidates, checked, workers)
+    finally:
+        check_required_location.context = None
+
+
+# Runs in a worker process.
+def check_required_location(task):
+    index, removed = task
+    search, collection_spheres, candidates, positions = check_required_location.context
+    location = candidates[index]
+    sphere_index, position = positions[index]
+    sphere = collection_spheres[sphere_index]
+
+    # Start from the cache of the location's sphere, rather than from the first sphere.
+    states = [state.world.state.copy() for state in search.state_list]
+    for found in itertools.chain(itertools.chain.from_iterable(collection_spheres[:sphere_index]), sphere[position + 1:]):
+        states[found.item.world.id].collect(found.item)
+    sphere_search = search.search_from_sphere(sphere_index + 1, states, unvisited=sphere[:position + 1])
+
+    removed_locations = [candidates[earlier] for earlier in removed] + [location]
+    removed_items = [removed_location.item for removed_location in removed_locations]
+    for removed_location in removed_locations:
+        removed_location.item = None
+    try:
+        return not sphere_search.can_beat_game()
+    finally:
+        for removed_location, item in zip(removed_locations, removed_items):
+            removed_location.item = item
+
+check_required_location.context = None
+
+
+# Returns whether the game can't be beaten without each of the entrances that
+# create_playthrough checks, in the order it checks them.
+def find_required_entrances(entrance_search, entrances, workers):
+    check_required_entrance.context = (entrance_search, entrances)
+    try:
+        return run_required_checks(check_required_entrance, entrances, [True] * len(entrances), workers)
+    finally:
+        check_required_entrance.context = None
+
+
+# Runs in a worker process.
+def check_required_entrance(task):
+    index, removed = task
+    entrance_search, entrances = check_required_entrance.context
+    disconnected = [entrances[earlier] for earlier in removed] + [entrances[index]]
+    regions = [entrance.disconnect() for entrance in disconnected]
+    try:
+        return not can_beat_game_without_entrances(entrance_search, disconnected)
+    finally:
+        for entrance, region in reversed(list(zip(disconnected, regions))):
+            entrance.connect(region)
+
+check_required_entrance.context = None
@@ -4,71 +4,241 @@ import io
 import array
 import zlib
 import copy
+import itertools
 import zipfile
 from ntype import BigStream
+from Utils import import_numpy
 
 
-# get the next XOR key. Uses some location in the source rom.
-# This will skip of 0s, since if we hit a block of 0s, the
-# patch data will be raw.
-def key_next(rom, key_address, address_range):
-    key = 0
-    while key == 0:
-        key_address += 1
-        if key_address > address_range[1]:
-            key_address = address_range[0]
-        key = rom.original.buffer[key_address]
-    return key, key_address
+# The XOR keys, which are the bytes of the source rom in address_range that
+# aren't 0. The keys are used in order starting after key_address, and wrap
+# around to the start of the range. 0s are skipped, since if we hit a block
+# of 0s, the patch data would be raw.
+class KeyStream(object):
+
+    def __init__(self, buffer, address_range, key_address):
+        self.keys = bytes(buffer[address_range[0]:address_range[1] + 1]).replace(b'\x00', b'')
+        # the first key is the one after key_address
+        self.index = len(bytes(buffer[address_range[0]:key_address + 1]).replace(b'\x00', b'')) % len(self.keys)
+
+
+    def take(self, count):
+        keys = bytearray()
+        while count > 0:
+            part = self.keys[self.index:self.index + count]
+            keys += part
+            count -= len(part)
+            self.index = (self.index + len(part)) % len(self.keys)
+        return keys
+
+
+    def next(self):
+        return self.take(1)[0]
+
+
+    def skip(self, count):
+        self.index = (self.index + count) % len(self.keys)
+
+
+    def rewind(self, count):
+        self.index = (self.index - count) % len(self.keys)
+
+
+    # Takes a key for each byte of data that isn't 0, returned in the
+    # positions of those bytes with 0s everywhere else.
+    def align(self, data):
+        keys = bytes(self.take(len(data) - data.count(0)))
+        numpy = import_numpy()
+        if numpy is not None:
+            aligned = numpy.zeros(len(data), dtype=numpy.uint8)
+            aligned[numpy.frombuffer(data, dtype=numpy.uint8) != 0] = numpy.frombuffer(keys, dtype=numpy.uint8)
+            return aligned.tobytes()
+        # without numpy, the keys are lined up with the data in pure python
+        segments = data.split(b'\x00')
+        ends = list(itertools.accumulate(map(len, segments)))
+        return b'\x00'.join(map(keys.__getitem__, map(slice, [0] + ends[:-1], ends)))
+
+
+def xor_bytes(a, b):
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+
+
+# maps 0 to 1 and every other byte to 0
+zero_flags = bytes([1] + [0] * 255)
+
+
+# Writes a patch file as it is built, compressing the data in chunks so
+# that only the last chunk is held in memory.
+class PatchWriter(BigStream):
+
+    def __init__(self, outfile, chunk_size=0x10000):
+        super().__init__(bytearray())
+        self.outfile = outfile
+        self.chunk_size = chunk_size
+        self.compressor = zlib.compressobj()
+
+
+    def append_byte(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+
+    def append_bytes(self, values):
+        self.buffer.extend(values)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+
+    def flush(self):
+        self.outfile.write(self.compressor.compress(self.buffer))
+        self.buffer = bytearray()
+
+
+    # Writes out the rest of the patch. Nothing can be appended after.
+    def close(self):
+        self.flush()
+        self.outfile.write(self.compressor.flush())
+
+
+# Reads a patch file in order, decompressing it a chunk at a time so that
+# only the part being read is held in memory.
+class PatchReader(BigStream):
+
+    def __init__(self, stream, chunk_size=0x10000):
+        super().__init__(b'')
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decompressor = zlib.decompressobj()
+        # position in buffer of the next byte to read
+        self.offset = 0
+
+
+    # Decompresses until length bytes are ready to read or the patch ends.
+    def fill(self, length):
+        while len(self.buffer) - self.offset < length and not self.decompressor.eof:
+            data = self.decompressor.unconsumed_tail or self.stream.read(self.chunk_size)
+            if data:
+                data = self.decompressor.decompress(data, self.chunk_size)
+            else:
+                data = self.decompressor.flush()
+                if not data:
+                    raise Exception("Patch file is truncated.")
+            self.buffer = self.buffer[self.offset:] + data
+            self.offset = 0
+
+
+    def eof(self):
+        self.fill(1)
+        return self.offset >= len(self.buffer)
+
+
+    def read_byte(self, address=None):
+        return self.read_bytes(address)[0]
+
+
+    def read_bytes(self, address=None, length=1):
+        if address is not None and address != self.last_address:
+            raise Exception("Patch files can only be read in order.")
+        self.fill(length)
+        data = self.buffer[self.offset:self.offset + length]
+        if len(data) < length:
+            raise Exception("Patch file is truncated.")
+        self.offset += length
+        self.last_address += length
+        return data
+
+
+# Yields, in order, the runs of written addresses outside of the DMA table
+# that differ from new_buffer or are forced into the patch, as (start, end)
+# ranges. Written ranges that are unchanged are skipped with one comparison.
+def get_changed_ranges(rom, new_buffer, dma_start, dma_end):
+    force_patch = set(rom.force_patch)
+    for range_start, range_end in rom.changed_ranges:
+        for start, end in ((range_start, min(range_end, dma_start)), (max(range_start, dma_end), range_end)):
+            if start >= end:
+                continue
+            old_data = new_buffer[start:end]
+            new_data = rom.buffer[start:end]
+            if old_data == new_data:
+                for address in sorted(address for address in force_patch if start <= address < end):
+                    yield address, address + 1
+                continue
+            run_start = None
+            for address, old_value, new_value in zip(range(start, end), old_data, new_data):
+                if old_value != new_value or address in force_patch:
+                    if run_start is None:
+                        run_start = address
+                elif run_start is not None:
+                    yield run_start, address
+                    run_start = None
+            if run_start is not None:
+                yield run_start, end
 
 
 # creates a XOR block for the patch. This might break it up into
 # multiple smaller blocks if there is a concern about the XOR key
 # or if it is too long.
-def write_block(rom, xor_address, xor_range, block_start, data, patch_data):
-    new_data = []
+def write_block(keys, block_start, data, patch_data):
+    data = bytes(data)
+    new_data = bytearray()
     key_offset = 0
     continue_block = False
 
-    for b in data:
-        if b == 0:
-            # Leave 0s as 0s. Do not XOR
-            new_data += [0]
+    # A byte matches its key about once every 256 bytes, so the data is XORed
+    # in chunks around as long as the distance between the last matches.
+    chunk_size = 0x100
+    position = 0
+    while position < len(data):
+        # XOR as much as fits in this block at once. 0s are left as 0s.
+        chunk = data[position:position + min(chunk_size, 0xFFFF - len(new_data))]
+        encoded = xor_bytes(chunk, keys.align(chunk))
+
+        # if the XOR would result in 0, change the key.
+        # This requires breaking up the block.
+        collision = (int.from_bytes(encoded, 'big') | int.from_bytes(chunk.translate(zero_flags), 'big')) \
+            .to_bytes(len(chunk), 'big').find(0)
+        if collision < 0:
+            new_data += encoded
+            position += len(chunk)
+            chunk_size *= 2
         else:
-            # get the next XOR key
-            key, xor_address = key_next(rom, xor_address, xor_range)
-
-            # if the XOR would result in 0, change the key.
-            # This requires breaking up the block.
-            if b == key:
-                write_block_section(block_start, key_offset, new_data, patch_data, continue_block)
-                new_data = []
-                key_offset = 0
-                continue_block = True
-
-                # search for next safe XOR key
-                while b == key:
-                    key_offset += 1
-                    key, xor_address = key_next(rom, xor_address, xor_range)
-                    # if we aren't able to find one quickly, we may need to break again
-                    if key_offset == 0xFF:
-                        write_block_section(block_start, key_offset, new_data, patch_data, continue_block)
-                        new_data = []
-                        key_offset = 0
-                        continue_block = True
+            chunk_size = max(0x40, collision * 2)
+            new_data += encoded[:collision]
+            # give back the keys taken for the rest of the chunk, except this byte's
+            keys.rewind(len(chunk) - collision - chunk.count(0, collision) - 1)
+            b = chunk[collision]
+            key = b
+
+            write_block_section(block_start, key_offset, new_data, patch_data, continue_block)
+            new_data = bytearray()
+            key_offset = 0
+            continue_block = True
+
+            # search for next safe XOR key
+            while b == key:
+                key_offset += 1
+                key = keys.next()
+                # if we aren't able to find one quickly, we may need to break again
+                if key_offset == 0xFF:
+                    write_block_section(block_start, key_offset, new_data, patch_data, continue_block)
+                    new_data = bytearray()
+                    key_offset = 0
+                    continue_block = True
 
             # XOR the key with the byte
-            new_data += [b ^ key]
+            new_data.append(b ^ key)
+            position += collision + 1
 
-            # Break the block if it's too long
-            if (len(new_data) == 0xFFFF):
-                write_block_section(block_start, key_offset, new_data, patch_data, continue_block)
-                new_data = []
-                key_offset = 0
-                continue_block = True
+        # Break the block if it's too long
+        if len(new_data) == 0xFFFF:
+            write_block_section(block_start, key_offset, new_data, patch_data, continue_block)
+            new_data = bytearray()
+            key_offset = 0
+            continue_block = True
 
     # Save the block
     write_block_section(block_start, key_offset, new_data, patch_data, continue_block)
-    return xor_address
 
 
 # This saves a sub-block for the XOR block. If it's the first part
@@ -89,10 +259,16 @@ def write_block_section(start, key_skip, in_data, patch_data, is_continue):
 # too important, but I tried to choose from a section that didn't really
 # have big gaps of 0s which we want to avoid.
 def create_patch_file(rom, file, xor_range=(0x00B8AD30, 0x00F029A0)):
+    with open(file, 'wb') as outfile:
+        patch_data = PatchWriter(outfile)
+        write_patch_data(rom, patch_data, xor_range)
+        patch_data.close()
+
+
+def write_patch_data(rom, patch_data, xor_range):
     dma_start, dma_end = rom.get_dma_table_range()
 
     # add header
-    patch_data = BigStream([])
     patch_data.append_bytes(list(map(ord, 'ZPFv1')))
     patch_data.append_int32(dma_start)
     patch_data.append_int32(xor_range[0])
@@ -102,6 +278,7 @@ def create_patch_file(rom, file, xor_range=(0x00B8AD30, 0x00F029A0)):
     # doesn't have many sections of 0s
     xor_address = random.Random().randint(*xor_range)
     patch_data.append_int32(xor_address)
+    keys = KeyStream(rom.original.buffer, xor_range, xor_address)
 
     new_buffer = copy.copy(rom.original.buffer)
 
@@ -115,8 +292,7 @@ def create_patch_file(rom, file, xor_range=(0x00B8AD30, 0x00F029A0)):
         # We don't trust files that have modified DMA to have their
         # changed addresses tracked correctly, so we invalidate the
         # entire file
-        for address in range(start, start + size):
-            rom.changed_address[address] = rom.buffer[address]
+        rom.mark_changed(start, start + size)
 
         # Simulate moving the files to know which addresses have changed
         if from_file >= 0:
@@ -133,62 +309,53 @@ def create_patch_file(rom, file, xor_range=(0x00B8AD30, 0x00F029A0)):
 
     # filter down the addresses that will actually need to change.
     # Make sure to not include any of the DMA table addresses
-    changed_addresses = [address for address,value in rom.changed_address.items() \
-        if (address >= dma_end or address < dma_start) and \
-            (address in rom.force_patch or new_buffer[address] != value)]
-    changed_addresses.sort()
+    changed_ranges = get_changed_ranges(rom, new_buffer, dma_start, dma_end)
 
     # Write the address changes. We'll store the data with XOR so that
     # the patch data won't be raw data from the patched rom.
-    data = []
+    data = bytearray()
     block_start = None
     BLOCK_HEADER_SIZE = 7 # this is used to break up gaps
-    for address in changed_addresses:
+    for start, end in changed_ranges:
         # if there's a block to write and there's a gap, write it
         if block_start:
             block_end = block_start + len(data) - 1
-            if address > block_end + BLOCK_HEADER_SIZE:
-                xor_address = write_block(rom, xor_address, xor_range, block_start, data, patch_data)
-                data = []
+            if start > block_end + BLOCK_HEADER_SIZE:
+                write_block(keys, block_start, data, patch_data)
+                data = bytearray()
                 block_start = None
                 block_end = None
 
         # start a new block
         if not block_start:
-            block_start = address
-            block_end = address - 1             
+            block_start = start
+            block_end = start - 1
 
         # save the new data
-        data += rom.buffer[block_end+1:address+1]
+        data += rom.buffer[block_end+1:end]
 
     # if there was any left over blocks, write them out
     if block_start:
-        xor_address = write_block(rom, xor_address, xor_range, block_start, data, patch_data)
-
-    # compress the patch file
-    patch_data = bytes(patch_data.buffer)
-    patch_data = zlib.compress(patch_data)
-
-    # save the patch file
-    with open(file, 'wb') as outfile:
-        outfile.write(patch_data)
+        write_block(keys, block_start, data, patch_data)
 
 
 # This will apply a patch file to a source rom to generate a patched rom.
 def apply_patch_file(rom, file, sub_file=None):
-    # load the patch file and decompress
+    # load the patch file, which is decompressed as it is read
     if sub_file:
         with zipfile.ZipFile(file, 'r') as patch_archive:
             try:
-                with patch_archive.open(sub_file, 'r') as stream:
-                    patch_data = stream.read()
+                stream = patch_archive.open(sub_file, 'r')
             except KeyError as ex:
                 raise FileNotFoundError('Patch file missing from archive. Invalid Player ID.')
+            with stream:
+                read_patch_data(rom, PatchReader(stream))
     else:
         with open(file, 'rb') as stream:
-            patch_data = stream.read()
-    patch_data = BigStream(zlib.decompress(patch_data))
+            read_patch_data(rom, PatchReader(stream))
+
 
+def read_patch_data(rom, patch_data):
     # make sure the header is correct
     if patch_data.read_bytes(length=4) != b'ZPFv':
         raise Exception("File is not in a Zelda Patch Format")
@@ -202,6 +369,7 @@ def apply_patch_file(rom, file, sub_file=None):
     dma_start = patch_data.read_int32()
     xor_range = (patch_data.read_int32(), patch_data.read_int32())
     xor_address = patch_data.read_int32()
+    keys = KeyStream(rom.original.buffer, xor_range, xor_address)
 
     # Load all the DMA table updates. This will move the files around.
     # A key thing is that some of these entries will list a source file
@@ -239,31 +407,23 @@ def apply_patch_file(rom, file, sub_file=None):
     # Read in the XOR data blocks. This goes to the end of the file.
     block_start = None
     while not patch_data.eof():
-        is_new_block = patch_data.read_byte() != 0xFF
+        first_byte = patch_data.read_byte()
 
-        if is_new_block:
+        if first_byte != 0xFF:
             # start writing a new block
-            patch_data.seek_address(delta=-1)
-            block_start = patch_data.read_int32()
+            block_start = (first_byte << 24) | patch_data.read_int24()
             block_size = patch_data.read_int16()
         else:
             # continue writing from previous block
             key_skip = patch_data.read_byte()
             block_size = patch_data.read_int16()
             # skip specified XOR keys
-            for _ in range(key_skip):
-                key, xor_address = key_next(rom, xor_address, xor_range)
-
-        # read in the new data
-        data = []
-        for b in patch_data.read_bytes(length=block_size):
-            if b == 0:
-                # keep 0s as 0s
-                data += [0]
-            else:
-                # The XOR will always be safe and will never produce 0
-                key, xor_address = key_next(rom, xor_address, xor_range)
-                data += [b ^ key]
+            keys.skip(key_skip)
+
+        # read in the new data. 0s are kept as 0s, and the XOR
+        # will always be safe and will never produce 0
+        data = bytes(patch_data.read_bytes(length=block_size))
+        data = xor_bytes(data, keys.align(data))
 
         # Save the new data to rom
         rom.write_bytes(block_start, data)
@@ -8,7 +8,7 @@ import datetime
 import sys
 
 from Gui import guiMain
-from Main import main, from_patch_file, cosmetic_patch
+from Main import main, main_batch, from_patch_file, cosmetic_patch
 from Utils import check_version, VersionError, check_python_version, local_path
 from Settings import get_settings_from_command_line_args
 
@@ -53,6 +53,11 @@ def start():
             cosmetic_patch(settings)
         elif settings.patch_file != '':
             from_patch_file(settings)
+        elif settings.count != None and settings.count > 1 and settings.batch_workers > 1:
+            results = main_batch(settings)
+            failures = [result['seed'] for result in results if result['error'] is not None]
+            if failures:
+                raise Exception('Failed to generate seeds: %s' % ', '.join(failures))
         elif settings.count != None and settings.count > 1:
             orig_seed = settings.seed
             for i in range(settings.count):
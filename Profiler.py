@@ -0,0 +1,97 @@
+from contextlib import contextmanager
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+from Search import Search
+
+
+# Search.cache_stats counts the stages report
+search_counters = ('searches', 'spheres', 'rule_checks')
+
+
+# Peak resident set size of this process so far, in MB, or None where it can't be read.
+# Stages record it when they end, so it only grows from one stage to the next.
+def peak_rss():
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return maxrss / (1024 * 1024) if sys.platform == 'darwin' else maxrss / 1024
+
+
+# Records the time, memory and search work of the stages of a generation, for the
+# profile_stages setting. Stages nest, and are named by their path from the outermost,
+# like 'generate/place_items/progression items'. A stage entered more than once,
+# such as on a retried attempt, adds up the totals of each time.
+class StageProfile(object):
+
+    def __init__(self):
+        self.path = []
+        # map stage path -> totals, in the order the stages were first entered
+        self.stages = {}
+
+
+    def enter(self, name):
+        self.path.append(name)
+        path = '/'.join(self.path)
+        if path not in self.stages:
+            self.stages[path] = {
+                'stage': path,
+                'depth': len(self.path) - 1,
+                'calls': 0,
+                'wall_seconds': 0.0,
+                'cpu_seconds': 0.0,
+                'peak_rss_mb': None,
+                **{counter: 0 for counter in search_counters},
+            }
+        return (path, time.perf_counter(), time.process_time(),
+                {counter: Search.cache_stats[counter] for counter in search_counters})
+
+
+    def exit(self, start):
+        path, wall_start, cpu_start, counters_start = start
+        self.path.pop()
+        stage = self.stages[path]
+        stage['calls'] += 1
+        stage['wall_seconds'] += time.perf_counter() - wall_start
+        stage['cpu_seconds'] += time.process_time() - cpu_start
+        for counter in search_counters:
+            stage[counter] += Search.cache_stats[counter] - counters_start[counter]
+        stage['peak_rss_mb'] = peak_rss()
+
+
+    def to_json(self):
+        return {
+            'python': sys.version.split()[0],
+            'platform': sys.platform,
+            'stages': list(self.stages.values()),
+        }
+
+
+    def to_file(self, filename):
+        with open(filename, 'w') as outfile:
+            json.dump(self.to_json(), outfile, indent=4)
+
+
+# Records the enclosed code as a stage of the profile in profile_stage.profile,
+# if there is one.
+@contextmanager
+def profile_stage(name):
+    profile = profile_stage.profile
+    if profile is None:
+        yield
+        return
+    start = profile.enter(name)
+    try:
+        yield
+    finally:
+        profile.exit(start)
+
+profile_stage.profile = None
@@ -24,6 +24,35 @@ class TimeOfDay(object):
     ALL = DAY | DAMPE
 
 
+# Combines access rules into one that passes when all of them do. The rules are
+# called in turn rather than through all(), as the combined rule is called often
+# during searches. It depends on the items of all the rules, if they are known.
+def all_rules(rules):
+    rules = tuple(rules)
+    if len(rules) == 1:
+        return rules[0]
+    if len(rules) == 2:
+        first, second = rules
+        combined = lambda state, **kwargs: first(state, **kwargs) and second(state, **kwargs)
+    else:
+        def combined(state, **kwargs):
+            for rule in rules:
+                if not rule(state, **kwargs):
+                    return False
+            return True
+    dependencies = [getattr(rule, 'dependencies', None) for rule in rules]
+    if None not in dependencies:
+        combined.dependencies = frozenset().union(*dependencies)
+    return combined
+
+
+# The access rule of spots until they are given one. It depends on no items.
+def no_rule(state, **kwargs):
+    return True
+
+no_rule.dependencies = frozenset()
+
+
 class Region(object):
 
     def __init__(self, name, type=RegionType.Overworld):
@@ -43,6 +72,8 @@ class Region(object):
         self.provides_time = TimeOfDay.NONE
         self.scene = None
         self.font_color = None
+        # Dense index among the regions of all worlds, see World.index_spots
+        self.index = None
 
 
     def copy(self, new_world):
@@ -56,6 +87,7 @@ class Region(object):
         new_region.provides_time = self.provides_time
         new_region.scene = self.scene
         new_region.font_color = self.font_color
+        new_region.index = self.index
 
         if self.dungeon:
             new_region.dungeon = self.dungeon.name
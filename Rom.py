@@ -1,3 +1,4 @@
+import bisect
 import io
 import itertools
 import json
@@ -10,20 +11,135 @@ import random
 import copy
 from Utils import is_bundled, subprocess_args, local_path, data_path, default_output_path, get_version_bytes
 from ntype import BigStream, uint32
-from crc import calculate_crc
+from crc import crc_data, crc_from_data
 from version import __version__
 
 DMADATA_START = 0x7430
 
+
+# A bytearray-like view of the ROM that leaves the base data untouched, which is
+# usually the decompressed ROM file mapped read-only. Writes go to copies of the
+# pages they touch, so copying the buffer or going back to the base only costs
+# as much as what has been written. Past the end of the base data, the buffer
+# reads as 0s up to its size.
+class OverlayBuffer(object):
+
+    PAGE_SIZE = 0x1000
+
+    def __init__(self, base, size=None, pages=None):
+        self.base = base
+        self.size = len(base) if size is None else size
+        # map page index -> bytearray of the page, for the pages that were written
+        self.pages = {} if pages is None else pages
+
+
+    def __len__(self):
+        return self.size
+
+
+    def __copy__(self):
+        return OverlayBuffer(self.base, self.size, {index: bytearray(page) for index, page in self.pages.items()})
+
+
+    # Grows the buffer to size. The new addresses read as 0s.
+    def pad(self, size):
+        self.size = max(self.size, size)
+
+
+    def _read_base(self, start, end):
+        data = self.base[start:end]
+        if len(data) < end - start:
+            data += bytes(end - start - len(data))
+        return data
+
+
+    def _page(self, index):
+        page = self.pages.get(index)
+        if page is None:
+            start = index * self.PAGE_SIZE
+            page = bytearray(self._read_base(start, start + self.PAGE_SIZE))
+            self.pages[index] = page
+        return page
+
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, end, step = key.indices(self.size)
+            if step != 1:
+                return bytearray(self[address] for address in range(start, end, step))
+            if end <= start:
+                return bytearray()
+            first, last = start // self.PAGE_SIZE, (end - 1) // self.PAGE_SIZE
+            if not any(index in self.pages for index in range(first, last + 1)):
+                return bytearray(self._read_base(start, end))
+            data = bytearray()
+            for index in range(first, last + 1):
+                page_start = index * self.PAGE_SIZE
+                segment_start = max(start, page_start)
+                segment_end = min(end, page_start + self.PAGE_SIZE)
+                page = self.pages.get(index)
+                if page is None:
+                    data += self._read_base(segment_start, segment_end)
+                else:
+                    data += page[segment_start - page_start:segment_end - page_start]
+            return data
+
+        if key < 0:
+            key += self.size
+        if not 0 <= key < self.size:
+            raise IndexError('ROM address out of range')
+        page = self.pages.get(key // self.PAGE_SIZE)
+        if page is not None:
+            return page[key % self.PAGE_SIZE]
+        return self.base[key] if key < len(self.base) else 0
+
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            start, end, step = key.indices(self.size)
+            data = bytes(value)
+            if step != 1:
+                addresses = range(start, end, step)
+                if len(addresses) != len(data):
+                    raise ValueError('ROM writes cannot change the size of the buffer')
+                for address, byte in zip(addresses, data):
+                    self[address] = byte
+                return
+            if len(data) != max(0, end - start):
+                raise ValueError('ROM writes cannot change the size of the buffer')
+            offset = 0
+            while offset < len(data):
+                address = start + offset
+                page_offset = address % self.PAGE_SIZE
+                length = min(len(data) - offset, self.PAGE_SIZE - page_offset)
+                self._page(address // self.PAGE_SIZE)[page_offset:page_offset + length] = data[offset:offset + length]
+                offset += length
+            return
+
+        if key < 0:
+            key += self.size
+        if not 0 <= key < self.size:
+            raise IndexError('ROM address out of range')
+        self._page(key // self.PAGE_SIZE)[key % self.PAGE_SIZE] = value
+
+
+    def write_to(self, outfile, chunk_size=0x100000):
+        for start in range(0, self.size, chunk_size):
+            outfile.write(self[start:start + chunk_size])
+
+
 class Rom(BigStream):
 
     def __init__(self, file=None):
         super().__init__([])
 
         self.original = None
-        self.changed_address = {}
+        # sorted, coalesced (start, end) ranges of the addresses that have been written
+        self.changed_ranges = []
         self.changed_dma = {}
         self.force_patch = []
+        # the data the header checksum was last computed from, and the checksum
+        self.last_crc = None
 
         if file is None:
             return
@@ -51,7 +167,7 @@ class Rom(BigStream):
         self.decompress_rom_file(file, decomp_file)
 
         # Add file to maximum size
-        self.buffer.extend(bytearray([0x00] * (0x4000000 - len(self.buffer))))
+        self.buffer.pad(0x4000000)
         self.original = self.copy()
 
         # Add version number to header.
@@ -62,7 +178,7 @@ class Rom(BigStream):
     def copy(self):
         new_rom = Rom()
         new_rom.buffer = copy.copy(self.buffer)
-        new_rom.changed_address = copy.copy(self.changed_address)
+        new_rom.changed_ranges = copy.copy(self.changed_ranges)
         new_rom.changed_dma = copy.copy(self.changed_dma)
         new_rom.force_patch = copy.copy(self.force_patch)
         return new_rom
@@ -119,17 +235,44 @@ class Rom(BigStream):
 
     def write_byte(self, address, value):
         super().write_byte(address, value)
-        self.changed_address[self.last_address-1] = value
+        self.mark_changed(self.last_address-1, self.last_address)
 
 
     def write_bytes(self, address, values):
         super().write_bytes(address, values)
-        self.changed_address.update(zip(range(address, address+len(values)), values))
+        self.mark_changed(self.last_address-len(values), self.last_address)
+
+
+    # Records that the addresses from start up to end have been written. Only the
+    # ranges are tracked; the buffer holds their values.
+    def mark_changed(self, start, end):
+        if start >= end:
+            return
+        ranges = self.changed_ranges
+        # Most writes are at or just past the end of the last range written
+        if not ranges or start > ranges[-1][1]:
+            ranges.append((start, end))
+            return
+        last_start, last_end = ranges[-1]
+        if start >= last_start:
+            ranges[-1] = (last_start, max(last_end, end))
+            return
+
+        # merge with every range that overlaps or touches this one
+        first = bisect.bisect_left(ranges, (start, start))
+        if first > 0 and ranges[first-1][1] >= start:
+            first -= 1
+        last = first
+        while last < len(ranges) and ranges[last][0] <= end:
+            start = min(start, ranges[last][0])
+            end = max(end, ranges[last][1])
+            last += 1
+        ranges[first:last] = [(start, end)]
 
 
     def restore(self):
         self.buffer = copy.copy(self.original.buffer)
-        self.changed_address = {}
+        self.changed_ranges = []
         self.changed_dma = {}
         self.force_patch = []
         self.last_address = None
@@ -145,19 +288,22 @@ class Rom(BigStream):
         self.verify_dmadata()
         self.update_header()
         with open(file, 'wb') as outfile:
-            outfile.write(self.buffer)
+            self.buffer.write_to(outfile)
 
 
     def update_header(self):
-        crc = calculate_crc(self)
-        self.write_bytes(0x10, crc)
+        # The checksum is only computed again when the data it covers has changed
+        data = crc_data(self)
+        if self.last_crc is None or self.last_crc[0] != data:
+            self.last_crc = (data, crc_from_data(*data))
+        self.write_bytes(0x10, self.last_crc[1])
 
 
     def read_rom(self, file):
-        # "Reads rom into bytearray"
+        # "Reads rom into bytes, with an overlay for the changes"
         try:
             with open(file, 'rb') as stream:
-                self.buffer = bytearray(stream.read())
+                self.buffer = OverlayBuffer(stream.read())
         except FileNotFoundError as ex:
             raise FileNotFoundError('Invalid path to Base ROM: "' + file + '"')
 
@@ -1,14 +1,21 @@
 import ast
-from collections import defaultdict
+from collections import Counter, defaultdict
+import copy
+import hashlib
 from inspect import signature, _ParameterKind
 import logging
+import marshal
+import os
+import pickle
 import re
+import sys
 
 from Item import ItemInfo, MakeEventItem
 from Location import Location
 from Region import TimeOfDay
-from State import State
-from Utils import data_path, read_json
+from State import State, state_function_dependencies
+from Utils import data_path, default_output_path, read_json
+from version import __version__
 
 
 escaped_items = {}
@@ -28,9 +35,34 @@ kwarg_defaults = {
 
 allowed_globals = {'TimeOfDay': TimeOfDay}
 
+# State functions that take item names, mapped to their item id equivalents.
+item_id_functions = {
+    'has': 'has_id',
+    'has_any_of': 'has_any_of_ids',
+    'has_all_of': 'has_all_of_ids',
+    'count_of': 'count_of_ids',
+}
+
 rule_aliases = {}
 nonaliases = set()
 
+# Names in logic files that may refer to world attributes or settings.
+identifier = re.compile(r'[A-Za-z_]\w*')
+# World attributes and settings the transformer reads without them being named in the logic.
+transformer_attributes = ('ensure_tod_access', 'logic_no_night_tokens_without_suns_song')
+# map logic file path -> (content digest, identifiers in the file)
+logic_files = {}
+
+# Compiled rules shared by all the worlds in the process.
+# map ast dump of a transformed rule -> (access rule, code, item names it reads)
+# The dump includes every setting the parser inlined, and rules only reach
+# their world through the state they are given, so equal dumps can share a rule.
+compiled_rules = {}
+# map logic cache key -> parsed logic file, see Rule_AST_Transformer.open_logic_cache
+parsed_logic_files = {}
+# Parsed logic files kept in memory, oldest dropped first.
+max_parsed_logic_files = 128
+
 def load_aliases():
     j = read_json(data_path('LogicHelpers.json'))
     for s, repl in j.items():
@@ -44,12 +76,105 @@ def load_aliases():
     nonaliases = escaped_items.keys() - rule_aliases.keys()
 
 
+def read_logic_file(file_path):
+    if file_path not in logic_files:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        logic_files[file_path] = (hashlib.sha256(data).hexdigest(), frozenset(identifier.findall(data.decode('utf-8'))))
+    return logic_files[file_path]
+
+
+# Digest of the code that turns logic into compiled rules, for the logic cache.
+def parser_digest():
+    if parser_digest.cached is None:
+        digest = hashlib.sha256(('%s %s' % (__version__, sys.version)).encode())
+        for module in (__name__, 'State', 'ItemList'):
+            with open(sys.modules[module].__file__, 'rb') as f:
+                digest.update(f.read())
+        parser_digest.cached = digest.hexdigest()
+    return parser_digest.cached
+
+parser_digest.cached = None
+
+
+# A stable description of a world attribute or setting, for the logic cache.
+# Plain data is described by value. Anything else can't be inlined
+# into rules, so it is only described by type.
+def fingerprint_value(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        return '%s(%s)' % (type(value).__name__, ','.join(map(fingerprint_value, value)))
+    if isinstance(value, (set, frozenset)):
+        return '%s(%s)' % (type(value).__name__, ','.join(sorted(map(fingerprint_value, value))))
+    if isinstance(value, dict):
+        return 'dict(%s)' % ','.join('%s:%s' % (fingerprint_value(k), fingerprint_value(v)) for k, v in value.items())
+    return type(value).__name__
+
+
+def remember_parsed_logic_file(key, parsed):
+    if len(parsed_logic_files) >= max_parsed_logic_files:
+        del parsed_logic_files[next(iter(parsed_logic_files))]
+    parsed_logic_files[key] = parsed
+
+
 def isliteral(expr):
     return isinstance(expr, (ast.Num, ast.Str, ast.Bytes, ast.NameConstant))
 
 
+# Rewrites item checks on literal names, e.g. state.has('Bow'),
+# into lookups by interned item id, e.g. state.has_id(12).
+# Also records which item ids the rule reads, or marks the rule opaque
+# if it depends on anything else (e.g. region reachability).
+# This is a final pass: the rule transformer itself groups and caches
+# checks by name, so it must only be run on a copy of the finished rule.
+class Item_Id_Transformer(ast.NodeTransformer):
+
+    def __init__(self):
+        self.dependencies = set()
+        self.opaque = False
+        # Item names looked up, in order, so cached code can be checked against the ids in use.
+        self.item_names = []
+
+
+    def get_id(self, name):
+        self.item_names.append(name)
+        return ItemInfo.get_id(name)
+
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if not (isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name)
+                and node.func.value.id == 'state'):
+            self.opaque = True
+            return node
+        if node.func.attr in state_function_dependencies:
+            self.dependencies.update(state_function_dependencies[node.func.attr])
+            return node
+        if node.func.attr not in item_id_functions or not node.args:
+            self.opaque = True
+            return node
+
+        items = node.args[0]
+        if isinstance(items, ast.Str):
+            item_ids = self.get_id(items.s)
+            self.dependencies.add(item_ids)
+        elif isinstance(items, ast.Tuple) and all(isinstance(elt, ast.Str) for elt in items.elts):
+            item_ids = tuple(self.get_id(elt.s) for elt in items.elts)
+            self.dependencies.update(item_ids)
+        else:
+            self.opaque = True
+            return node
+        node.func.attr = item_id_functions[node.func.attr]
+        node.args[0] = ast.Constant(item_ids)
+        return node
+
+
 class Rule_AST_Transformer(ast.NodeTransformer):
 
+    # Counts of logic files and rules parsed or compiled, and reused from the caches, across all worlds.
+    cache_stats = Counter()
+
     def __init__(self, world):
         self.world = world
         self.events = set()
@@ -62,10 +187,22 @@ class Rule_AST_Transformer(ast.NodeTransformer):
             load_aliases()
         # final rule cache
         self.rule_cache = {}
+        # logic file cache, see open_logic_cache
+        self.cache_key = None
+        self.cache_path = None
+        # the file a replayed entry was loaded from, or None if it was already in memory
+        self.cached_path = None
+        self.cached_entry = None
+        self.cached_rules = None
+        self.cached_compiled = None
+        self.cached_state = None
+        self.recorded_rules = None
+        self.recorded_compiled = None
+        self.state_before = None
 
 
     def visit_Name(self, node):
-        if node.id in dir(self):
+        if hasattr(self, node.id):
             return getattr(self, node.id)(node)
         elif node.id in rule_aliases:
             args, repl = rule_aliases[node.id]
@@ -155,7 +292,7 @@ class Rule_AST_Transformer(ast.NodeTransformer):
         if not isinstance(node.func, ast.Name):
             return node
 
-        if node.func.id in dir(self):
+        if hasattr(self, node.func.id):
             return getattr(self, node.func.id)(node)
         elif node.func.id in rule_aliases:
             args, repl = rule_aliases[node.func.id]
@@ -372,6 +509,18 @@ class Rule_AST_Transformer(ast.NodeTransformer):
 
     # Requires the target regions have been defined in the world.
     def create_delayed_rules(self):
+        # Worlds with the same logic create the same events, so reuse them if possible.
+        cache_key = self.delayed_rules_key()
+        cached = parsed_logic_files.get(cache_key)
+        if cached is not None:
+            Rule_AST_Transformer.cache_stats['files_shared'] += 1
+            self.create_cached_delayed_rules(cached)
+            return
+
+        Rule_AST_Transformer.cache_stats['files_parsed'] += 1
+        events_before = set(self.events)
+        replaced_counts = {target: len(rules) for target, rules in self.replaced_rules.items()}
+        created = []
         for region_name, node, subrule_name in self.delayed_rules:
             region = self.world.get_region(region_name)
             event = Location(subrule_name, type='Event', parent=region, internal=True)
@@ -379,7 +528,9 @@ class Rule_AST_Transformer(ast.NodeTransformer):
 
             self.current_spot = event
             # This could, in theory, create further subrules.
-            access_rule = self.make_access_rule(self.visit(node))
+            body = self.visit(node)
+            rule_str = ast.dump(body, False)
+            access_rule = self.make_access_rule(body, rule_str)
             if access_rule is self.rule_cache.get('NameConstant(False)') or access_rule is self.rule_cache.get('Constant(False)'):
                 event.access_rule = None
                 event.never = True
@@ -391,35 +542,206 @@ class Rule_AST_Transformer(ast.NodeTransformer):
                 region.locations.append(event)
 
                 MakeEventItem(subrule_name, event)
+                created.append((region_name, subrule_name, rule_str, event.always))
+        remember_parsed_logic_file(cache_key, {
+            'created': created,
+            'events': self.events - events_before,
+            'replaced_rules': [(target, rule, item_rule) for target, rules in self.replaced_rules.items()
+                               for rule, item_rule in list(rules.items())[replaced_counts.get(target, 0):]],
+        })
         # Safeguard in case this is called multiple times per world
         self.delayed_rules.clear()
 
 
-    def make_access_rule(self, body):
-        rule_str = ast.dump(body, False)
+    # Creates the events recorded by create_delayed_rules for another world.
+    def create_cached_delayed_rules(self, cached):
+        for region_name, subrule_name, rule_str, always in cached['created']:
+            region = self.world.get_region(region_name)
+            event = Location(subrule_name, type='Event', parent=region, internal=True)
+            event.world = self.world
+            event.always = always
+            if rule_str not in self.rule_cache:
+                self.rule_cache[rule_str] = compiled_rules[rule_str][0]
+            event.set_rule(self.rule_cache[rule_str])
+            region.locations.append(event)
+
+            MakeEventItem(subrule_name, event)
+        self.events.update(cached['events'])
+        for target, rule, item_rule in cached['replaced_rules']:
+            self.replaced_rules[target][rule] = item_rule
+        self.delayed_rules.clear()
+
+
+    def make_access_rule(self, body, rule_str=None):
+        if rule_str is None:
+            rule_str = ast.dump(body, False)
         if rule_str not in self.rule_cache:
-            # requires consistent iteration on dicts
-            kwargs = [ast.arg(arg=k) for k in kwarg_defaults.keys()]
-            kwd = list(map(ast.Constant, kwarg_defaults.values()))
-            try:
-                self.rule_cache[rule_str] = eval(compile(
-                    ast.fix_missing_locations(
-                        ast.Expression(ast.Lambda(
-                            args=ast.arguments(
-                                posonlyargs=[],
-                                args=[ast.arg(arg='state')],
-                                defaults=[],
-                                kwonlyargs=kwargs,
-                                kw_defaults=kwd),
-                            body=body))),
-                    '<string>', 'eval'),
+            if rule_str in compiled_rules:
+                Rule_AST_Transformer.cache_stats['rules_shared'] += 1
+            else:
+                # requires consistent iteration on dicts
+                kwargs = [ast.arg(arg=k) for k in kwarg_defaults.keys()]
+                kwd = list(map(ast.Constant, kwarg_defaults.values()))
+                id_transformer = Item_Id_Transformer()
+                id_body = id_transformer.visit(copy.deepcopy(body))
+                try:
+                    code = compile(
+                        ast.fix_missing_locations(
+                            ast.Expression(ast.Lambda(
+                                args=ast.arguments(
+                                    posonlyargs=[],
+                                    args=[ast.arg(arg='state')],
+                                    defaults=[],
+                                    kwonlyargs=kwargs,
+                                    kw_defaults=kwd),
+                                body=id_body))),
+                        '<string>', 'eval')
                     # globals/locals. if undefined, everything in the namespace *now* would be allowed
-                    allowed_globals)
-            except TypeError as e:
-                raise Exception('Parse Error: %s' % e, self.current_spot.name, ast.dump(body, False))
+                    access_rule = eval(code, allowed_globals)
+                except TypeError as e:
+                    raise Exception('Parse Error: %s' % e, self.current_spot.name, ast.dump(body, False))
+                # Item ids this rule reads, so a Search can skip re-evaluating it until one changes.
+                # None means the rule may change for other reasons and must always be re-evaluated.
+                access_rule.dependencies = None if id_transformer.opaque else frozenset(id_transformer.dependencies)
+                compiled_rules[rule_str] = (access_rule, code, tuple(id_transformer.item_names))
+                Rule_AST_Transformer.cache_stats['rules_compiled'] += 1
+            access_rule, code, item_names = compiled_rules[rule_str]
+            self.rule_cache[rule_str] = access_rule
+            if self.recorded_compiled is not None:
+                self.recorded_compiled[rule_str] = (marshal.dumps(code), item_names,
+                        tuple(map(ItemInfo.get_id, item_names)), access_rule.dependencies)
         return self.rule_cache[rule_str]
 
 
+    # Like make_access_rule, but reuses the code compiled for the rule in the run
+    # that wrote the logic cache, if the item names it reads have the same ids now.
+    # Item ids are interned in the same order either way.
+    def make_cached_access_rule(self, body, rule_str):
+        if rule_str not in self.rule_cache and rule_str not in compiled_rules and rule_str in self.cached_compiled:
+            code, item_names, item_ids, dependencies = self.cached_compiled[rule_str]
+            if tuple(map(ItemInfo.get_id, item_names)) == item_ids:
+                code = marshal.loads(code)
+                access_rule = eval(code, allowed_globals)
+                access_rule.dependencies = dependencies
+                compiled_rules[rule_str] = (access_rule, code, item_names)
+                self.rule_cache[rule_str] = access_rule
+                Rule_AST_Transformer.cache_stats['rules_loaded'] += 1
+        return self.make_access_rule(body, rule_str)
+
+
+    ## Cache of parsed logic files, shared by all the worlds in the process, and
+    # persisted on disk if the logic_cache setting is enabled.
+    # An entry holds the parsed rules of one logic file, and the parser state the file
+    # adds (events, subrules, delayed rules). Its key covers everything the parse
+    # can depend on: the logic and parser sources, the world attributes and settings
+    # named in the logic, and the parser state left by the files parsed before it.
+
+    def logic_cache_key(self, file_path):
+        file_digest, names = read_logic_file(file_path)
+        return self.parser_state_key(file_digest, names)
+
+
+    # The key for the delayed rules of this world, which are parsed after all its logic files.
+    def delayed_rules_key(self):
+        delayed_rules = repr([(region_name, ast.dump(node, False), subrule_name) for region_name, node, subrule_name in self.delayed_rules])
+        return self.parser_state_key(hashlib.sha256(('delayed' + delayed_rules).encode()).hexdigest(), frozenset(identifier.findall(delayed_rules)))
+
+
+    # Hashes the digest of some logic with everything its parse can depend on,
+    # given the names in it.
+    def parser_state_key(self, logic_digest, names):
+        helpers_digest, helper_names = read_logic_file(data_path('LogicHelpers.json'))
+        key = hashlib.sha256()
+        for digest in (parser_digest(), logic_digest, helpers_digest):
+            key.update(digest.encode())
+        for name in sorted(names | helper_names | set(transformer_attributes)):
+            for source in (self.world.__dict__, self.world.settings.__dict__):
+                key.update(('%s=%s;' % (name, fingerprint_value(source[name]) if name in source else '')).encode())
+        key.update(repr(sorted(self.events)).encode())
+        for target, rules in self.replaced_rules.items():
+            key.update(repr((target, list(rules))).encode())
+        key.update(repr([subrule_name for _, _, subrule_name in self.delayed_rules]).encode())
+        return key.hexdigest()
+
+
+    # Starts replaying the cached parse of the given logic file, if any,
+    # or else recording it. Must be followed by close_logic_cache.
+    # Returns the template of the file's regions, if a world in this process
+    # already loaded it with the same key (see World.load_regions_from_json).
+    def open_logic_cache(self, file_path):
+        self.cache_key = self.logic_cache_key(file_path)
+        cached = parsed_logic_files.get(self.cache_key)
+        if cached is not None:
+            Rule_AST_Transformer.cache_stats['files_shared'] += 1
+        elif self.world.settings.logic_cache:
+            cache_dir = os.path.join(default_output_path(self.world.settings.output_dir), 'Cache')
+            self.cache_path = os.path.join(cache_dir, 'logic-%s.pickle' % self.cache_key)
+            try:
+                with open(self.cache_path, 'rb') as f:
+                    cached = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                pass
+            else:
+                Rule_AST_Transformer.cache_stats['files_loaded'] += 1
+                remember_parsed_logic_file(self.cache_key, cached)
+                self.cached_path = self.cache_path
+                self.cache_path = None
+
+        if cached is None:
+            Rule_AST_Transformer.cache_stats['files_parsed'] += 1
+            self.recorded_rules = []
+            # Compiled code is only needed to write the entry to disk.
+            self.recorded_compiled = {} if self.cache_path else None
+            self.state_before = (set(self.events), {target: len(rules) for target, rules in self.replaced_rules.items()}, len(self.delayed_rules))
+            return None
+        self.cached_entry = cached
+        self.cached_rules = iter(cached['rules'])
+        self.cached_compiled = cached['compiled']
+        self.cached_state = (cached['events'], cached['replaced_rules'], cached['delayed_rules'])
+        return cached.get('template')
+
+
+    # Applies the parser state added by a replayed file, or stores the entry for a recorded one.
+    # The given region template is kept with the entry, in memory only.
+    def close_logic_cache(self, template=None):
+        if self.cached_rules is not None:
+            # Rules not parsed through parse_rule were cloned from a template.
+            for _, rule_str, _ in self.cached_rules:
+                if rule_str not in self.rule_cache:
+                    self.rule_cache[rule_str] = compiled_rules[rule_str][0]
+            if template is not None:
+                self.cached_entry['template'] = template
+            events, replaced_rules, delayed_rules = self.cached_state
+            self.events.update(events)
+            for target, rule, item_rule in replaced_rules:
+                self.replaced_rules[target][rule] = item_rule
+            # Delayed rules are transformed in place, so each world needs its own.
+            self.delayed_rules.extend(copy.deepcopy(delayed_rules))
+        elif self.recorded_rules is not None:
+            events, replaced_counts, delayed_count = self.state_before
+            cached = {
+                'rules': self.recorded_rules,
+                'compiled': self.recorded_compiled or {},
+                'events': self.events - events,
+                'replaced_rules': [(target, rule, item_rule) for target, rules in self.replaced_rules.items()
+                                   for rule, item_rule in list(rules.items())[replaced_counts.get(target, 0):]],
+                'delayed_rules': copy.deepcopy(self.delayed_rules[delayed_count:]),
+            }
+            if self.cache_path:
+                os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+                # Write to a temporary file first, so concurrent runs never read a partial entry.
+                temp_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+                with open(temp_path, 'wb') as f:
+                    pickle.dump(cached, f, pickle.HIGHEST_PROTOCOL)
+                os.replace(temp_path, self.cache_path)
+            if template is not None:
+                cached['template'] = template
+            remember_parsed_logic_file(self.cache_key, cached)
+        self.cache_key = self.cache_path = self.cached_path = None
+        self.cached_entry = self.cached_rules = self.cached_compiled = self.cached_state = None
+        self.recorded_rules = self.recorded_compiled = self.state_before = None
+
+
     ## Handlers for specific internal functions used in the json logic.
 
     # at(region_name, rule)
@@ -471,7 +793,19 @@ class Rule_AST_Transformer(ast.NodeTransformer):
     # If spot is None, here() rules won't work.
     def parse_rule(self, rule_string, spot=None):
         self.current_spot = spot
-        return self.make_access_rule(self.visit(ast.parse(rule_string, mode='eval').body))
+        if self.cached_rules is not None:
+            # A logic file with the same content parses to the same rules in the same order.
+            cached_string, rule_str, body = next(self.cached_rules)
+            if cached_string != rule_string:
+                if self.cached_path is None:
+                    raise Exception('In-memory logic cache entry %s does not match the logic.' % self.cache_key)
+                raise Exception('Logic cache entry %s does not match the logic. Delete it to rebuild.' % self.cached_path)
+            return self.make_cached_access_rule(body, rule_str)
+        body = self.visit(ast.parse(rule_string, mode='eval').body)
+        rule_str = ast.dump(body, False)
+        if self.recorded_rules is not None:
+            self.recorded_rules.append((rule_string, rule_str, body))
+        return self.make_access_rule(body, rule_str)
 
     def parse_spot_rule(self, spot):
         rule = spot.rule_string.split('#', 1)[0].strip()
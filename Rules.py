@@ -3,14 +3,13 @@ import logging
 from Location import DisableType
 from SaveContext import SaveContext
 from Search import Search
-from State import State
 
 
 def set_rules(world):
     logger = logging.getLogger('')
 
     # ganon can only carry triforce
-    world.get_location('Ganon').item_rule = lambda location, item: item.name == 'Triforce'
+    limit_to_itemset(world.get_location('Ganon'), ['Triforce'])
 
     guarantee_hint = world.parser.parse_rule('guarantee_hint')
     is_child = world.parser.parse_rule('is_child')
@@ -24,11 +23,11 @@ def set_rules(world):
                         and item.type != 'Song')
                     or (item.type == 'Song' and item.world.id == location.world.id))
             else:
-                add_item_rule(location, lambda location, item: item.type != 'Song')
+                forbid_item_type(location, 'Song')
 
         if location.type == 'Shop':
             if location.name in world.shop_prices:
-                add_item_rule(location, lambda location, item: item.type != 'Shop')
+                forbid_item_type(location, 'Shop')
                 location.price = world.shop_prices[location.name]
                 # If price was specified in plando, use it here so access rule is set correctly.
                 if location.name in world.distribution.locations and world.distribution.locations[location.name].price is not None:
@@ -43,11 +42,12 @@ def set_rules(world):
                     world.shop_prices[location.name] = price
                 location.add_rule(create_shop_rule(location))
             else:
-                add_item_rule(location, lambda location, item: item.type == 'Shop' and item.world.id == location.world.id)
+                limit_to_item_type(location, 'Shop')
+                limit_to_own_world(location)
         elif location.type in ['Scrub', 'GrottoScrub']:
             location.add_rule(create_shop_rule(location))
         else:
-            add_item_rule(location, lambda location, item: item.type != 'Shop')
+            forbid_item_type(location, 'Shop')
 
         if world.settings.skip_child_zelda and location.name == 'Song from Impa':
             limit_to_itemset(location, SaveContext.giveable_items)
@@ -89,19 +89,71 @@ def set_rule(spot, rule):
     spot.access_rule = rule
 
 
+# Item rules are kept as constraints on the location, which are compiled into a
+# single item_rule each time one is added, instead of wrapping the previous rule.
 def add_item_rule(spot, rule):
-    old_rule = spot.item_rule
-    spot.item_rule = lambda location, item: rule(location, item) and old_rule(location, item)
+    spot.item_rules += (rule,)
+    compile_item_rule(spot)
 
 
 def forbid_item(location, item_name):
-    old_rule = location.item_rule
-    location.item_rule = lambda loc, item: item.name != item_name and old_rule(loc, item)
+    location.forbidden_items = location.forbidden_items | {item_name}
+    compile_item_rule(location)
 
 
 def limit_to_itemset(location, itemset):
-    old_rule = location.item_rule
-    location.item_rule = lambda loc, item: item.name in itemset and old_rule(loc, item)
+    if location.allowed_items is None:
+        location.allowed_items = frozenset(itemset)
+    else:
+        location.allowed_items = location.allowed_items.intersection(itemset)
+    compile_item_rule(location)
+
+
+def forbid_item_type(location, item_type):
+    location.forbidden_item_types = location.forbidden_item_types | {item_type}
+    compile_item_rule(location)
+
+
+def limit_to_item_type(location, item_type):
+    if location.allowed_item_types is None:
+        location.allowed_item_types = frozenset([item_type])
+    else:
+        location.allowed_item_types = location.allowed_item_types & {item_type}
+    compile_item_rule(location)
+
+
+def limit_to_own_world(location):
+    location.own_world_items = True
+    compile_item_rule(location)
+
+
+def compile_item_rule(location):
+    forbidden_items = location.forbidden_items
+    allowed_items = location.allowed_items
+    forbidden_item_types = location.forbidden_item_types
+    allowed_item_types = location.allowed_item_types
+    own_world_items = location.own_world_items
+    item_rules = location.item_rules
+
+    # Most locations only forbid shop items and songs
+    if allowed_items is None and allowed_item_types is None and not own_world_items and not item_rules:
+        location.item_rule = lambda location, item: item.name not in forbidden_items and item.type not in forbidden_item_types
+        return
+
+    def item_rule(location, item):
+        if item.name in forbidden_items or item.type in forbidden_item_types:
+            return False
+        if allowed_items is not None and item.name not in allowed_items:
+            return False
+        if allowed_item_types is not None and item.type not in allowed_item_types:
+            return False
+        if own_world_items and item.world.id != location.world.id:
+            return False
+        for rule in item_rules:
+            if not rule(location, item):
+                return False
+        return True
+    location.item_rule = item_rule
 
 
 def item_in_locations(state, item, locations):
@@ -122,6 +174,7 @@ def set_shop_rules(world):
     wallet = world.parser.parse_rule('Progressive_Wallet')
     wallet2 = world.parser.parse_rule('(Progressive_Wallet, 2)')
     is_adult = world.parser.parse_rule('is_adult')
+    has_bottle = world.parser.parse_rule('has_bottle')
     for location in world.get_filled_locations():
         if location.item.type == 'Shop':
             # Add wallet requirements
@@ -145,7 +198,7 @@ def set_shop_rules(world):
                                       'Buy Red Potion [40]',
                                       'Buy Red Potion [50]',
                                       'Buy Fairy\'s Spirit']:
-                location.add_rule(State.has_bottle)
+                location.add_rule(has_bottle)
             if location.item.name in ['Buy Bombchu (10)', 'Buy Bombchu (20)', 'Buy Bombchu (5)']:
                 location.add_rule(found_bombchus)
 
@@ -1,13 +1,31 @@
 import copy
-from collections import defaultdict
+from collections import Counter, defaultdict
 import itertools
 
+from Entrance import Entrance
 from Region import TimeOfDay
 from State import State
 
+
+# The containers in a sphere cache, which are shared copy-on-write between
+# copies of a Search and between the spheres of a RewindableSearch.
+cache_containers = (
+    'child_queue', 'adult_queue', 'visited_locations',
+    'child_regions', 'adult_regions', 'child_blocked', 'adult_blocked',
+)
+
+# Set in the tod flags of the regions a search has reached (see TimeOfDay).
+reached = 4
+
+
 class Search(object):
 
+    # Counts of sphere caches forked and of containers actually copied, across all searches,
+    # along with the searches made, the spheres explored and the access rules evaluated.
+    cache_stats = Counter()
+
     def __init__(self, state_list, initial_cache=None):
+        Search.cache_stats['searches'] += 1
         self.state_list = [state.copy() for state in state_list]
 
         # Let the states reference this search.
@@ -19,27 +37,77 @@ class Search(object):
             self.cached_spheres = [self._cache]
         else:
             root_regions = [state.world.get_region('Root') for state in self.state_list]
-            # The cache is a dict with 5 values:
-            #  child_regions, adult_regions: maps of Region -> tod, all the regions in that sphere
-            #    values are lazily-determined tod flags (see TimeOfDay).
+            region_count = max(state.world.region_index_end for state in self.state_list)
+            location_count = max(state.world.location_index_end for state in self.state_list)
+            # The cache is a dict with 8 values:
+            #  child_regions, adult_regions: arrays of tod flags indexed by Region.index,
+            #    with the reached flag set for all the regions in that sphere.
+            #    Other tod flags are lazily determined (see TimeOfDay).
             #  child_queue, adult_queue: queue of Entrance, all the exits to try next sphere
-            #  visited_locations: set of Locations visited in or before that sphere.
+            #  visited_locations: array indexed by Location.index, set for the
+            #    Locations visited in or before that sphere.
+            #  child_blocked, adult_blocked: set of Entrances and Locations whose access rule
+            #    failed at that age, and that don't need to be retried until one of the
+            #    items the rule depends on is collected. Blocked exits are not in the queue.
+            #    Candidates to unblock are found through World.rule_dependents.
+            #  shared: map of key -> owner count, for the containers above that are shared
+            #    with other caches. The count is a one-element list shared by all the owners.
+            #    Shared containers are copied before being modified (see _writable).
             self._cache = {
                 'child_queue': list(exit for region in root_regions for exit in region.exits),
                 'adult_queue': list(exit for region in root_regions for exit in region.exits),
-                'visited_locations': set(),
-                'child_regions': {region: TimeOfDay.NONE for region in root_regions},
-                'adult_regions': {region: TimeOfDay.NONE for region in root_regions},
+                'visited_locations': bytearray(location_count),
+                'child_regions': bytearray(region_count),
+                'adult_regions': bytearray(region_count),
+                'child_blocked': set(),
+                'adult_blocked': set(),
+                'shared': {},
             }
+            for region in root_regions:
+                self._cache['child_regions'][region.index] = reached
+                self._cache['adult_regions'][region.index] = reached
             self.cached_spheres = [self._cache]
             self.next_sphere()
 
 
     def copy(self):
         # we only need to copy the top sphere since that's what we're starting with and we don't go back
-        new_cache = {k: copy.copy(v) for k,v in self._cache.items()}
         # copy always makes a nonreversible instance
-        return Search(self.state_list, initial_cache=new_cache)
+        return Search(self.state_list, initial_cache=self._fork_cache())
+
+
+    # Returns a new cache sharing every container with the current one, or the given one.
+    # Both caches copy a container the first time they modify it.
+    def _fork_cache(self, cache=None):
+        cache = cache or self._cache
+        shared = cache['shared']
+        for key in cache_containers:
+            if key in shared:
+                shared[key][0] += 1
+            else:
+                shared[key] = [2]
+        new_cache = dict(cache)
+        new_cache['shared'] = dict(shared)
+        Search.cache_stats['forks'] += 1
+        return new_cache
+
+
+    # Gives up this cache's share of the given container.
+    # Returns whether another cache still uses it.
+    def _release(self, key, cache=None):
+        owners = (cache or self._cache)['shared'].pop(key, None)
+        if owners is None:
+            return False
+        owners[0] -= 1
+        return owners[0] > 0
+
+
+    # Returns the given cache container, ready to be modified in place.
+    def _writable(self, key):
+        if self._release(key):
+            self._cache[key] = copy.copy(self._cache[key])
+            Search.cache_stats['copies'] += 1
+        return self._cache[key]
 
 
     def collect_all(self, itempool):
@@ -92,40 +160,105 @@ class Search(object):
         raise Exception('Unimplemented for Search. Perhaps you want RewindableSearch.')
 
 
-    # Internal to the iteration. Modifies the exit_queue, regions. 
+    # Called by State.collect. Requeues the exits and allows retrying the locations
+    # whose access rules depend on the collected item.
+    def unblock(self, world_id, item):
+        rule_dependents = self.state_list[world_id].world.rule_dependents
+        for age in ('child', 'adult'):
+            blocked = self._cache[age + '_blocked']
+            if not blocked:
+                continue
+            unblocked = [spot for item_id in item_ids(item) for spot in rule_dependents.get(item_id, ()) if spot in blocked]
+            if not unblocked:
+                continue
+            blocked = self._writable(age + '_blocked')
+            queue = None
+            for spot in unblocked:
+                if spot in blocked:
+                    blocked.remove(spot)
+                    if isinstance(spot, Entrance):
+                        if queue is None:
+                            queue = self._writable(age + '_queue')
+                        queue.append(spot)
+
+
+    # Unblocks everything. Used when the cache may have been built
+    # with a different set of items than the states currently have.
+    def _unblock_all(self):
+        for age in ('child', 'adult'):
+            blocked = self._cache[age + '_blocked']
+            if not blocked:
+                continue
+            self._writable(age + '_queue').extend(spot for spot in blocked if isinstance(spot, Entrance))
+            self._release(age + '_blocked')
+            self._cache[age + '_blocked'] = set()
+
+
+    # Called when the spot's access rule passed at the given age, and the search reached it.
+    def _passed(self, spot, age):
+        pass
+
+
+    # Records that the spot's access rule failed at the given age, if the rule
+    # can only start passing once some item is collected.
+    def _block(self, spot, age, dependencies):
+        self._writable(age + '_blocked').add(spot)
+        rule_dependents = spot.world.rule_dependents
+        for item_id in dependencies:
+            if item_id in rule_dependents:
+                rule_dependents[item_id][spot] = None
+            else:
+                rule_dependents[item_id] = {spot: None}
+
+
+    # Internal to the iteration. Modifies the regions for the age, but not the
+    # exit_queue, which may be shared; exits to try afterwards go in a separate queue.
     # Returns a queue of the exits whose access rule failed, 
     # as a cache for the exits to try on the next iteration.
-    def _expand_regions(self, exit_queue, regions, age):
+    # Exits that failed but are blocked on items are left out of the queue.
+    def _expand_regions(self, exit_queue, age):
         failed = []
-        for exit in exit_queue:
-            if exit.connected_region and exit.connected_region not in regions:
+        regions = self._cache[age + '_regions']
+        pending = []
+        rule_checks = 0
+        for exit in itertools.chain(exit_queue, pending):
+            if exit.connected_region and not regions[exit.connected_region.index]:
                 # Evaluate the access rule directly, without tod
+                rule_checks += 1
                 if exit.access_rule(self.state_list[exit.world.id], spot=exit, age=age):
+                    regions = self._writable(age + '_regions')
+                    root_index = exit.world.get_region('Root').index
                     # If it found a new tod, make sure we try other entrances again.
                     # Probably would take too long and not be worth it if we only grabbed the exits
                     # for the given world...
-                    if exit.connected_region.provides_time and not regions[exit.world.get_region('Root')] & exit.connected_region.provides_time:
-                        exit_queue.extend(failed)
+                    if exit.connected_region.provides_time and not regions[root_index] & exit.connected_region.provides_time:
+                        pending.extend(failed)
                         failed = []
-                    regions[exit.connected_region] = exit.connected_region.provides_time
-                    regions[exit.world.get_region('Root')] |= exit.connected_region.provides_time
-                    exit_queue.extend(exit.connected_region.exits)
+                    regions[exit.connected_region.index] = reached | exit.connected_region.provides_time
+                    regions[root_index] |= exit.connected_region.provides_time
+                    pending.extend(exit.connected_region.exits)
+                    self._passed(exit, age)
                 else:
-                    failed.append(exit)
+                    dependencies = getattr(exit.access_rule, 'dependencies', None)
+                    if dependencies is None:
+                        failed.append(exit)
+                    else:
+                        self._block(exit, age, dependencies)
+        Search.cache_stats['rule_checks'] += rule_checks
         return failed
 
 
     def _expand_tod_regions(self, regions, goal_region, age, tod):
         # grab all the exits from the regions with the given tod in the same world as our goal.
         # we want those that go to existing regions without the tod, until we reach the goal.
-        has_tod_world = lambda regtod: regtod[1] & tod and regtod[0].world == goal_region.world
-        exit_queue = list(itertools.chain.from_iterable(region.exits for region, _ in filter(has_tod_world, regions.items())))
+        exit_queue = list(itertools.chain.from_iterable(region.exits for region in goal_region.world.regions if regions[region.index] & tod))
         for exit in exit_queue:
             # We don't look for new regions, just spreading the tod to our existing regions
-            if exit.connected_region in regions and tod & ~regions[exit.connected_region]:
+            if exit.connected_region and regions[exit.connected_region.index] and tod & ~regions[exit.connected_region.index]:
                 # Evaluate the access rule directly
+                Search.cache_stats['rule_checks'] += 1
                 if exit.access_rule(self.state_list[exit.world.id], spot=exit, age=age, tod=tod):
-                    regions[exit.connected_region] |= tod
+                    regions[exit.connected_region.index] |= tod
                     if exit.connected_region == goal_region:
                         return True
                     exit_queue.extend(exit.connected_region.exits)
@@ -133,22 +266,21 @@ class Search(object):
 
 
     # Explores available exits, updating relevant entries in the cache in-place.
-    # Returns the regions accessible in the new sphere as child,
-    # the regions accessible as adult, and the set of visited locations.
-    # These are references to the new entry in the cache, so they can be modified
-    # directly.
+    # Returns the region arrays for the new sphere as child and as adult,
+    # and the array of visited locations.
+    # These are references to the new entry in the cache, and may be shared
+    # with other caches, so they must not be modified directly (see _writable).
     def next_sphere(self):
+        Search.cache_stats['spheres'] += 1
 
         # Use the queue to iteratively add regions to the accessed set,
         # until we are stuck or out of regions.
-        self._cache.update({
-            # Replace the queues (which have been modified) with just the
+        for age in ('adult', 'child'):
+            # Replace the queues with just the
             # failed exits that we can retry next time.
-            'adult_queue': self._expand_regions(
-                self._cache['adult_queue'], self._cache['adult_regions'], 'adult'),
-            'child_queue': self._expand_regions(
-                self._cache['child_queue'], self._cache['child_regions'], 'child'),
-        })
+            exit_queue = self._cache[age + '_queue']
+            self._release(age + '_queue')
+            self._cache[age + '_queue'] = self._expand_regions(exit_queue, age)
         return self._cache['child_regions'], self._cache['adult_regions'], self._cache['visited_locations']
 
     # Yields every reachable location, by iteratively deepening explored sets of
@@ -163,28 +295,50 @@ class Search(object):
         had_reachable_locations = True
         # will loop as long as any visits were made, and at least once
         while had_reachable_locations:
-            child_regions, adult_regions, visited_locations = self.next_sphere()
+            child_regions, adult_regions, _ = self.next_sphere()
+            cache = self._cache
 
             # Get all locations in accessible_regions that aren't visited,
             # and check if they can be reached. Collect them.
+            # The visited and blocked sets are looked up each time, since the caller
+            # may copy this search, or collect items, between iterations.
             had_reachable_locations = False
+            # counted locally, and added to the stats before the caller can stop the iteration
+            rule_checks = 0
             for loc in item_locations:
-                if loc in visited_locations:
+                if cache['visited_locations'][loc.index]:
                     continue
                 # Check adult first; it's the most likely.
-                if (loc.parent_region in adult_regions
-                        and loc.access_rule(self.state_list[loc.world.id], spot=loc, age='adult')):
-                    had_reachable_locations = True
-                    # Mark it visited for this algorithm
-                    visited_locations.add(loc)
-                    yield loc
-
-                elif (loc.parent_region in child_regions
-                      and loc.access_rule(self.state_list[loc.world.id], spot=loc, age='child')):
-                    had_reachable_locations = True
-                    # Mark it visited for this algorithm
-                    visited_locations.add(loc)
-                    yield loc
+                if adult_regions[loc.parent_region.index] and loc not in cache['adult_blocked']:
+                    rule_checks += 1
+                    if loc.access_rule(self.state_list[loc.world.id], spot=loc, age='adult'):
+                        had_reachable_locations = True
+                        # Mark it visited for this algorithm
+                        self._writable('visited_locations')[loc.index] = 1
+                        self._passed(loc, 'adult')
+                        Search.cache_stats['rule_checks'] += rule_checks
+                        rule_checks = 0
+                        yield loc
+                        continue
+                    dependencies = getattr(loc.access_rule, 'dependencies', None)
+                    if dependencies is not None:
+                        self._block(loc, 'adult', dependencies)
+
+                if child_regions[loc.parent_region.index] and loc not in cache['child_blocked']:
+                    rule_checks += 1
+                    if loc.access_rule(self.state_list[loc.world.id], spot=loc, age='child'):
+                        had_reachable_locations = True
+                        # Mark it visited for this algorithm
+                        self._writable('visited_locations')[loc.index] = 1
+                        self._passed(loc, 'child')
+                        Search.cache_stats['rule_checks'] += rule_checks
+                        rule_checks = 0
+                        yield loc
+                        continue
+                    dependencies = getattr(loc.access_rule, 'dependencies', None)
+                    if dependencies is not None:
+                        self._block(loc, 'child', dependencies)
+            Search.cache_stats['rule_checks'] += rule_checks
 
 
     # This collects all item locations available in the state list given that
@@ -298,14 +452,14 @@ class Search(object):
     def can_reach(self, region, age=None, tod=TimeOfDay.NONE):
         if age == 'adult':
             if tod:
-                return region in self._cache['adult_regions'] and (self._cache['adult_regions'][region] & tod or self._expand_tod_regions(self._cache['adult_regions'], region, age, tod))
+                return self._cache['adult_regions'][region.index] and (self._cache['adult_regions'][region.index] & tod or self._expand_tod_regions(self._writable('adult_regions'), region, age, tod))
             else:
-                return region in self._cache['adult_regions']
+                return self._cache['adult_regions'][region.index] != 0
         elif age == 'child':
             if tod:
-                return region in self._cache['child_regions'] and (self._cache['child_regions'][region] & tod or self._expand_tod_regions(self._cache['child_regions'], region, age, tod))
+                return self._cache['child_regions'][region.index] and (self._cache['child_regions'][region.index] & tod or self._expand_tod_regions(self._writable('child_regions'), region, age, tod))
             else:
-                return region in self._cache['child_regions']
+                return self._cache['child_regions'][region.index] != 0
         elif age == 'both':
             return self.can_reach(region, age='adult', tod=tod) and self.can_reach(region, age='child', tod=tod)
         else:
@@ -319,16 +473,17 @@ class Search(object):
     # Use the cache in the search to determine location reachability.
     # Only works for locations that had progression items...
     def visited(self, location):
-        return location in self._cache['visited_locations']
+        return self._cache['visited_locations'][location.index] != 0
 
     # Use the cache in the search to get all reachable regions.
     def reachable_regions(self, age=None):
-        if age == 'adult':
-            return self._cache['adult_regions'].keys()
-        elif age == 'child':
-            return self._cache['child_regions'].keys()
+        if age == 'adult' or age == 'child':
+            regions = self._cache[age + '_regions']
+            return [region for state in self.state_list for region in state.world.regions if regions[region.index]]
         else:
-            return self._cache['adult_regions'].keys() + self._cache['child_regions'].keys()
+            adult_regions, child_regions = self._cache['adult_regions'], self._cache['child_regions']
+            return [region for state in self.state_list for region in state.world.regions
+                    if adult_regions[region.index] or child_regions[region.index]]
 
     # Returns whether the given age can access the spot at this age and tod,
     # by checking whether the search has reached the containing region, and evaluating the spot's access rule.
@@ -354,22 +509,219 @@ class RewindableSearch(Search):
         # in the top two caches (if it's the first being unvisited for a sphere)
         # in the topmost cache only (otherwise)
         # After we unvisit every location in a sphere, the top two caches have identical visited locations.
-        assert location in self.cached_spheres[-1]['visited_locations']
-        if location in self.cached_spheres[-2]['visited_locations']:
-            self.cached_spheres.pop()
+        assert self.cached_spheres[-1]['visited_locations'][location.index]
+        if self.cached_spheres[-2]['visited_locations'][location.index]:
+            self._drop_spheres(-1)
             self._cache = self.cached_spheres[-1]
-        self._cache['visited_locations'].discard(location)
+            # Items collected after this sphere may have unblocked spots.
+            self._unblock_all()
+        self._writable('visited_locations')[location.index] = 0
 
 
     def reset(self):
+        self._drop_spheres(1)
         self._cache = self.cached_spheres[0]
-        self.cached_spheres[1:] = []
+        self._unblock_all()
+
+
+    # Discards the sphere caches from the given index on,
+    # giving up their shares of any containers.
+    def _drop_spheres(self, index):
+        for cache in self.cached_spheres[index:]:
+            for key in list(cache['shared']):
+                self._release(key, cache)
+        self.cached_spheres[index:] = []
+
+
+    # Returns a plain search that starts from the cache of the given sphere, with the given states.
+    # The states must not hold items that were collected after that sphere was explored.
+    # The given locations are left unvisited.
+    def search_from_sphere(self, index, state_list, unvisited=()):
+        search = Search(state_list, initial_cache=self._fork_cache(self.cached_spheres[index]))
+        if unvisited:
+            visited_locations = search._writable('visited_locations')
+            for location in unvisited:
+                visited_locations[location.index] = 0
+        return search
 
 
     # Adds a new layer to the sphere cache, as a copy of the previous.
+    # The layers share containers until one of them is modified,
+    # so rewinding only drops what was written since the checkpoint.
     def checkpoint(self):
         # Save the current data into the cache.
-        self.cached_spheres.append({
-            k: copy.copy(v) for k, v in self._cache.items()
-        })
+        self.cached_spheres.append(self._fork_cache())
         self._cache = self.cached_spheres[-1]
+
+
+
+# The search behind the assumed fill: all the items left to place are assumed
+# collected, and taken out one at a time as they are placed.
+# Uncollecting an item retracts only what relied on it: the search keeps every
+# access rule that passed, in order, and checks again those that read the item,
+# or an item collected at a dropped location. Rules that read more than items,
+# like the time of day at a region, are checked again from the first of them on.
+# Those that fail now are dropped, along with the rules that passed in the regions
+# they reached.
+# collect_locations then explores again from what is left, and finds the same
+# locations as a new search with the remaining items would.
+class AssumedSearch(Search):
+
+    def __init__(self, state_list, initial_cache=None):
+        # The spots whose access rule passed since the search started, in order, as
+        # (spot, age, world id, dependencies, item collected there or None for exits).
+        # Whatever a rule relied on was found before it, so one pass finds all that is dropped.
+        self.passed_spots = []
+        super().__init__(state_list, initial_cache)
+
+
+    # Starts an assumed search from the current sphere of the given search.
+    @classmethod
+    def from_search(cls, search):
+        return cls(search.state_list, initial_cache=search._fork_cache())
+
+
+    def _passed(self, spot, age):
+        self.passed_spots.append((spot, age, spot.world.id, getattr(spot.access_rule, 'dependencies', None),
+                                  None if isinstance(spot, Entrance) else spot.item))
+
+
+    # Returns a copy of this search, whose items can be dropped separately.
+    def fork(self):
+        search = AssumedSearch(self.state_list, initial_cache=self._fork_cache())
+        search.passed_spots = list(self.passed_spots)
+        return search
+
+
+    # Drops the item this search found at the location, along with what relied on it.
+    # The location stays visited, so collect_locations doesn't find it again.
+    def uncollect_location(self, location, item):
+        for index, passed in enumerate(self.passed_spots):
+            if passed[0] is location:
+                del self.passed_spots[index]
+                self.uncollect(item)
+                return
+
+
+    # Drops the item from its state, along with what relied on it.
+    # Call collect_locations to find the locations still reachable.
+    def uncollect(self, item):
+        super().uncollect(item)
+        self._retract(item=item)
+
+
+    # Drops what went through the exits, whose connections changed since the search
+    # went through them, along with what relied on that. old_regions maps each exit
+    # to the region it led to then. The exits that are now connected are tried again.
+    # Call collect_locations to find what is still reachable.
+    def reconnect(self, exits, old_regions):
+        # Exits removed from their region are forgotten.
+        removed = [exit for exit in exits if exit.parent_region is None]
+        for age in ('child', 'adult'):
+            if removed:
+                self._writable(age + '_blocked').difference_update(removed)
+                queue = [exit for exit in self._cache[age + '_queue'] if exit.parent_region]
+                self._release(age + '_queue')
+                self._cache[age + '_queue'] = queue
+        self._retract(exits=exits, old_regions=old_regions)
+        for age in ('child', 'adult'):
+            regions = self._cache[age + '_regions']
+            requeued = [exit for exit in exits if exit.connected_region and regions[exit.parent_region.index]]
+            if requeued:
+                self._writable(age + '_queue').extend(requeued)
+
+
+    def _retract(self, item=None, exits=frozenset(), old_regions=None):
+        removed_ids = set(item_ids(item)) if item else set()
+        for first, (spot, _, world_id, dependencies, _) in enumerate(self.passed_spots):
+            if dependencies is None or spot in exits or (not removed_ids.isdisjoint(dependencies) and world_id == item.world.id):
+                break
+        else:
+            first = len(self.passed_spots)
+        retracted_spots = self.passed_spots[first:]
+        del self.passed_spots[first:]
+
+        # The items collected and the regions reached from here on are taken out,
+        # and added again as the spots are kept, so each rule sees what was found before it.
+        # The states only lose items, so nothing needs to be unblocked.
+        for state in self.state_list:
+            state.search = None
+        regions = {age: self._writable(age + '_regions') for age in ('child', 'adult')}
+        root_indexes = {state.world.id: state.world.get_region('Root').index for state in self.state_list}
+        for spot, age, _, _, location_item in retracted_spots:
+            if location_item is not None:
+                self.state_list[location_item.world.id].remove(location_item)
+            else:
+                region = old_regions[spot] if spot in exits else spot.connected_region
+                regions[age][region.index] = 0
+        # Times of day other than those regions provide are found lazily, and may have
+        # relied on what is dropped, so they are found again.
+        for age_regions in regions.values():
+            for state in self.state_list:
+                root = state.world.get_region('Root')
+                root_tod = reached
+                for region in state.world.regions:
+                    if age_regions[region.index] and region is not root:
+                        age_regions[region.index] = reached | region.provides_time
+                        root_tod |= region.provides_time
+                age_regions[root.index] = root_tod
+
+        visited_locations = None
+        # map world id -> ids of items that may be fewer than when rules passed
+        lost_items = defaultdict(set)
+        if item:
+            lost_items[item.world.id] = removed_ids
+        lost_regions = {'child': [], 'adult': []}
+        for passed in retracted_spots:
+            spot, age, world_id, dependencies, location_item = passed
+            world_lost_items = lost_items.get(world_id)
+            if spot in exits or not regions[age][spot.parent_region.index]:
+                kept = False
+            elif dependencies is None:
+                # The rule may read the regions and times of day reached, through the search.
+                Search.cache_stats['rule_checks'] += 1
+                for state in self.state_list:
+                    state.search = self
+                kept = spot.access_rule(self.state_list[world_id], spot=spot, age=age)
+                for state in self.state_list:
+                    state.search = None
+            elif world_lost_items and not world_lost_items.isdisjoint(dependencies):
+                Search.cache_stats['rule_checks'] += 1
+                kept = spot.access_rule(self.state_list[world_id], spot=spot, age=age)
+            else:
+                kept = True
+            if kept:
+                self.passed_spots.append(passed)
+                if location_item is not None:
+                    self.state_list[location_item.world.id].collect(location_item)
+                else:
+                    region = spot.connected_region
+                    regions[age][region.index] = reached | region.provides_time
+                    regions[age][root_indexes[world_id]] |= region.provides_time
+            elif location_item is None:
+                lost_regions[age].append(old_regions[spot] if spot in exits else spot.connected_region)
+            else:
+                if visited_locations is None:
+                    visited_locations = self._writable('visited_locations')
+                visited_locations[spot.index] = 0
+                lost_items[location_item.world.id].update(item_ids(location_item))
+        for state in self.state_list:
+            state.search = self
+
+        for age in ('child', 'adult'):
+            if not lost_regions[age]:
+                continue
+            age_regions = regions[age]
+            # Exits left in the lost regions must not be taken until they are reached again.
+            # Their exits are queued again then.
+            queue = [exit for exit in self._cache[age + '_queue'] if age_regions[exit.parent_region.index]]
+            queue.extend(entrance for region in lost_regions[age] for entrance in region.entrances
+                         if age_regions[entrance.parent_region.index] and not age_regions[region.index])
+            self._release(age + '_queue')
+            self._cache[age + '_queue'] = queue
+            blocked = self._writable(age + '_blocked')
+            blocked.difference_update([spot for spot in blocked if isinstance(spot, Entrance) and not age_regions[spot.parent_region.index]])
+
+
+def item_ids(item):
+    return (item.info.id, item.info.alias_id) if item.alias else (item.info.id,)
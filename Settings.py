@@ -339,6 +339,7 @@ def get_settings_from_command_line_args():
     parser.add_argument('--seed', help='Generate the specified seed.')
     parser.add_argument('--no_log', help='Suppresses the generation of a log file.', action='store_true')
     parser.add_argument('--output_settings', help='Always outputs a settings.json file even when spoiler is enabled.', action='store_true')
+    parser.add_argument('--profile_stages', help='Outputs the time, memory and search work of each stage of generation to a _Profile.json file.', action='store_true')
 
     args = parser.parse_args()
     settings_base = {}
@@ -369,6 +370,8 @@ def get_settings_from_command_line_args():
     settings = Settings(settings_base)
 
     settings.output_settings = args.output_settings
+    if args.profile_stages:
+        settings.profile_stages = True
 
     if args.settings_string is not None:
         settings.update_with_settings_string(args.settings_string)
@@ -1839,6 +1839,12 @@ setting_infos = [
         }),
     Setting_Info('output_file',       str, None, None, False, {}),
     Setting_Info('seed',              str, None, None, False, {}),
+    Setting_Info('logic_cache',       bool, None, None, False, {}),
+    Setting_Info('attempt_workers',   int, None, None, False, {}, default=1),
+    Setting_Info('batch_workers',     int, None, None, False, {}, default=1),
+    Setting_Info('playthrough_workers', int, None, None, False, {}, default=1),
+    Setting_Info('fill_compatibility', bool, None, None, False, {}),
+    Setting_Info('profile_stages',    bool, None, None, False, {}),
     Setting_Info('patch_file',        str, "Patch File", "Fileinput", False, {},
         gui_params = {
             "file_types": [
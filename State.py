@@ -1,15 +1,44 @@
-from collections import Counter
-import copy
+from array import array
 
 from Item import ItemInfo
 from Region import Region, TimeOfDay
 
 
+bottle_ids = tuple(map(ItemInfo.get_id, ItemInfo.bottles))
+medallion_ids = tuple(map(ItemInfo.get_id, ItemInfo.medallions))
+stone_ids = tuple(map(ItemInfo.get_id, ItemInfo.stones))
+reward_ids = medallion_ids + stone_ids
+triforce_id = ItemInfo.get_id('Triforce')
+triforce_piece_id = ItemInfo.get_id('Triforce Piece')
+rutos_letter_id = ItemInfo.get_id('Rutos Letter')
+heart_container_id = ItemInfo.get_id('Heart Container')
+piece_of_heart_id = ItemInfo.get_id('Piece of Heart')
+
+# State functions usable in rules whose result depends only on the given
+# item ids (or on nothing but settings, if empty). See RuleParser.
+state_function_dependencies = {
+    'has_bottle': bottle_ids + (rutos_letter_id,),
+    'has_hearts': (heart_container_id, piece_of_heart_id),
+    'heart_count': (heart_container_id, piece_of_heart_id),
+    'has_medallions': medallion_ids,
+    'has_stones': stone_ids,
+    'has_dungeon_rewards': reward_ids,
+    'had_night_start': (),
+    'can_live_dmg': (),
+}
+
+
+# A zeroed item counter with room for every item id interned so far.
+def empty_prog_items():
+    return array('H', bytes(2 * len(ItemInfo.item_names)))
+
+
 
 class State(object):
 
     def __init__(self, parent):
-        self.prog_items = Counter()
+        # Item counts indexed by ItemInfo id.
+        self.prog_items = empty_prog_items()
         self.world = parent
         self.search = None
         self._won = self.won_triforce_hunt if self.world.settings.triforce_hunt else self.won_normal
@@ -25,7 +54,7 @@ class State(object):
         if not new_world:
             new_world = self.world
         new_state = State(new_world)
-        new_state.prog_items = copy.copy(self.prog_items)
+        new_state.prog_items[:len(self.prog_items)] = self.prog_items
         return new_state
 
 
@@ -41,36 +70,80 @@ class State(object):
 
 
     def won_triforce_hunt(self):
-        return self.has('Triforce Piece', self.world.settings.triforce_goal_per_world)
+        return self.has_id(triforce_piece_id, self.world.settings.triforce_goal_per_world)
 
 
     def won_normal(self):
-        return self.has('Triforce')
+        return self.has_id(triforce_id)
 
 
     def has(self, item, count=1):
-        return self.prog_items[item] >= count
+        return self.item_count(item) >= count
 
 
     def has_any_of(self, items):
-        return any(map(self.prog_items.__contains__, items))
+        return any(map(self.item_count, items))
 
 
     def has_all_of(self, items):
-        return all(map(self.prog_items.__contains__, items))
+        return all(map(self.item_count, items))
 
 
     def count_of(self, items):
-        return len(list(filter(self.prog_items.__contains__, items)))
+        return len(list(filter(self.item_count, items)))
 
 
     def item_count(self, item):
-        return self.prog_items[item]
+        item_id = ItemInfo.item_ids.get(item)
+        if item_id is None or item_id >= len(self.prog_items):
+            return 0
+        return self.prog_items[item_id]
+
+
+    # Id-based variants of the above, emitted by the rule parser for compiled rules.
+    # Ids may be interned after this state was created, by rules compiled or added
+    # later, in which case the counts are grown to cover them first.
+    def has_id(self, item_id, count=1):
+        try:
+            return self.prog_items[item_id] >= count
+        except IndexError:
+            self.grow_prog_items()
+            return self.prog_items[item_id] >= count
+
+
+    def has_any_of_ids(self, item_ids):
+        try:
+            return any(map(self.prog_items.__getitem__, item_ids))
+        except IndexError:
+            self.grow_prog_items()
+            return any(map(self.prog_items.__getitem__, item_ids))
+
+
+    def has_all_of_ids(self, item_ids):
+        try:
+            return all(map(self.prog_items.__getitem__, item_ids))
+        except IndexError:
+            self.grow_prog_items()
+            return all(map(self.prog_items.__getitem__, item_ids))
+
+
+    def count_of_ids(self, item_ids):
+        try:
+            return len(list(filter(None, map(self.prog_items.__getitem__, item_ids))))
+        except IndexError:
+            self.grow_prog_items()
+            return len(list(filter(None, map(self.prog_items.__getitem__, item_ids))))
+
+
+    # Makes room for every item id interned so far.
+    def grow_prog_items(self):
+        if len(self.prog_items) < len(ItemInfo.item_names):
+            self.prog_items.extend(empty_prog_items()[len(self.prog_items):])
 
 
     def has_bottle(self, **kwargs):
         # Extra Ruto's Letter are automatically emptied
-        return self.has_any_of(ItemInfo.bottles) or self.has('Rutos Letter', 2)
+        return self.has_any_of_ids(bottle_ids) or self.has_id(rutos_letter_id, 2)
 
 
     def has_hearts(self, count):
@@ -81,31 +154,31 @@ class State(object):
     def heart_count(self):
         # Warning: This only considers items that are marked as advancement items
         return (
-            self.item_count('Heart Container')
-            + self.item_count('Piece of Heart') // 4
+            self.prog_items[heart_container_id]
+            + self.prog_items[piece_of_heart_id] // 4
             + 3 # starting hearts
         )
 
     def has_medallions(self, count):
-        return self.count_of(ItemInfo.medallions) >= count
+        return self.count_of_ids(medallion_ids) >= count
 
 
     def has_stones(self, count):
-        return self.count_of(ItemInfo.stones) >= count
+        return self.count_of_ids(stone_ids) >= count
 
 
     def has_dungeon_rewards(self, count):
-        return (self.count_of(ItemInfo.medallions) + self.count_of(ItemInfo.stones)) >= count
+        return self.count_of_ids(reward_ids) >= count
 
 
     def has_item_goal(self, item_goal):
-        return self.prog_items[item_goal['name']] >= item_goal['minimum']
+        return self.item_count(item_goal['name']) >= item_goal['minimum']
 
 
     def has_full_item_goal(self, category, goal, item_goal):
         local_goal = self.world.goal_categories[category.name].get_goal(goal.name)
         per_world_max_quantity = local_goal.get_item(item_goal['name'])['quantity']
-        return self.prog_items[item_goal['name']] >= per_world_max_quantity
+        return self.item_count(item_goal['name']) >= per_world_max_quantity
 
 
     def has_all_item_goals(self):
@@ -147,30 +220,37 @@ class State(object):
     # Be careful using this function. It will not collect any
     # items that may be locked behind the item, only the item itself.
     def collect(self, item):
+        # New events may have been interned since this state was created.
+        self.grow_prog_items()
         if item.alias:
-            self.prog_items[item.alias[0]] += item.alias[1]
+            self.prog_items[item.info.alias_id] += item.alias[1]
         if item.advancement:
-            self.prog_items[item.name] += 1
+            self.prog_items[item.info.id] += 1
+        if self.search is not None:
+            self.search.unblock(self.world.id, item)
 
 
     # Be careful using this function. It will not uncollect any
     # items that may be locked behind the item, only the item itself.
     def remove(self, item):
-        if item.alias and self.prog_items[item.alias[0]] > 0:
-            self.prog_items[item.alias[0]] -= item.alias[1]
-            if self.prog_items[item.alias[0]] <= 0:
-                del self.prog_items[item.alias[0]]
-        if self.prog_items[item.name] > 0:
-            self.prog_items[item.name] -= 1
-            if self.prog_items[item.name] <= 0:
-                del self.prog_items[item.name]
+        if item.alias and self.item_count(item.alias[0]) > 0:
+            self.prog_items[item.info.alias_id] = max(self.prog_items[item.info.alias_id] - item.alias[1], 0)
+        if self.item_count(item.name) > 0:
+            self.prog_items[item.info.id] -= 1
 
 
     def __getstate__(self):
-        return self.__dict__.copy()
+        state = self.__dict__.copy()
+        # Item ids are interned per process, so store the counts by name.
+        state['prog_items'] = {ItemInfo.item_names[item_id]: count for item_id, count in enumerate(self.prog_items) if count}
+        return state
 
 
     def __setstate__(self, state):
         self.__dict__.update(state)
+        item_ids = {ItemInfo.get_id(name): count for name, count in state['prog_items'].items()}
+        self.prog_items = empty_prog_items()
+        for item_id, count in item_ids.items():
+            self.prog_items[item_id] = count
 
 
@@ -3,20 +3,31 @@
 # See `python -m unittest -h` or `pytest -h` for more options.
 
 from collections import Counter, defaultdict
+import io
 import json
 import logging
+import multiprocessing
 import os
 import random
 import re
+import tempfile
 import unittest
+from unittest import mock
 
-from EntranceShuffle import EntranceShuffleError
+import crc
+import N64Patch
+from EntranceShuffle import EntranceShuffleError, validation_search
+from Hints import can_reach_hint
 from Item import ItemInfo
 from ItemPool import remove_junk_items, item_groups
 from LocationList import location_groups, location_is_viewable
-from Main import main, resolve_settings, build_world_graphs, place_items
+from Fill import ShuffleError
+from Main import main, main_batch, init_batch_worker, generate_batch_seed, resolve_settings, build_world_graphs, place_items, generate, attempt_seed, run_required_checks
+from Rom import Rom, OverlayBuffer
 from Search import Search
 from Settings import Settings, get_preset_files
+from Utils import import_numpy
+from ntype import BigStream
 
 test_dir = os.path.join(os.path.dirname(__file__), 'tests')
 output_dir = os.path.join(test_dir, 'Output')
@@ -393,6 +404,25 @@ class TestHints(unittest.TestCase):
         woth = spoiler[':barren_regions']
         self.assertIn('Hyrule Castle', woth)
 
+    def test_can_reach_hint_matches_max_explore(self):
+        settings = make_settings_for_test({'world_count': 2}, seed='TESTTESTTEST', outfilename='can-reach-hint')
+        spoiler = main(settings)
+        worlds = spoiler.worlds
+        stones = [location for location in worlds[0].get_locations() if location.type == 'HintStone'][::8]
+        stones.append(worlds[0].get_location('Ganondorf Hint'))
+        locations = [location for world in worlds for location in world.get_filled_locations() if location.item.advancement][::10]
+        for location in locations:
+            old_item = location.item
+            location.item = None
+            search = Search.max_explore([world.state for world in worlds])
+            location.item = old_item
+            for stone in stones:
+                with self.subTest(location.name, stone=stone.name):
+                    expected = (search.spot_access(stone)
+                                and (stone.type != 'HintStone' or search.state_list[location.world.id].guarantee_hint()))
+                    self.assertEqual(bool(can_reach_hint(worlds, stone, location)), bool(expected))
+            self.assertLessEqual(len(can_reach_hint.searches), can_reach_hint.max_searches)
+
     def test_ganondorf(self):
         filenames = [
             "light-arrows-1",
@@ -429,6 +459,383 @@ class TestEntranceRandomizer(unittest.TestCase):
             # If the test succeeds, this confirms Serenade and Prelude can be foolish.
             with self.assertRaises(EntranceShuffleError):
                 build_world_graphs(settings)
+            # the searches kept for validation are let go even when it fails
+            self.assertEqual(validation_search.kept, {})
+
+
+# map location name -> item name, for the filled locations of every world
+def get_placed_items(spoiler):
+    return {location.name: location.item.name for world in spoiler.worlds for location in world.get_filled_locations()}
+
+
+class TestParallelAttempts(unittest.TestCase):
+    def test_same_spoiler_as_series(self):
+        spoilers = {}
+        for workers in [1, 2]:
+            settings = make_settings_for_test({'attempt_workers': workers}, seed='TESTTESTTEST', outfilename='parallel-%d' % workers)
+            main(settings, max_attempts=2)
+            spoilers[workers] = load_spoiler('%s_Spoiler.json' % settings.output_file)
+        self.assertEqual(spoilers[1], spoilers[2])
+
+    def test_worker_attempt_generated_again(self):
+        # The first attempt fails here. Then the second, which succeeded in a worker,
+        # is generated again here, and if that fails too the third is used.
+        for failures in [1, 2]:
+            with self.subTest(failures=failures):
+                settings = make_settings_for_test({'attempt_workers': 2}, seed='TESTTESTTEST', outfilename='parallel-retry')
+                expected_settings = make_settings_for_test({}, seed='TESTTESTTEST', outfilename='parallel-retry')
+                resolve_settings(expected_settings)
+                expected_settings.reset_distribution()
+                random.seed(attempt_seed(expected_settings, failures + 1))
+                expected = get_placed_items(generate(expected_settings))
+
+                attempts = [ShuffleError('Failed on purpose')] * failures + [generate]
+                def generate_here(*args, **kwargs):
+                    attempt = attempts.pop(0)
+                    if isinstance(attempt, ShuffleError):
+                        raise attempt
+                    return attempt(*args, **kwargs)
+                with mock.patch('Main.generate', side_effect=generate_here):
+                    spoiler = main(settings, max_attempts=3)
+                self.assertEqual(get_placed_items(spoiler), expected)
+
+    def test_last_error_raised(self):
+        # As in series, the error of the last attempt is raised when every attempt fails.
+        settings = make_settings_for_test({'attempt_workers': 2}, seed='TESTTESTTEST', outfilename='parallel-error')
+        errors = [ShuffleError('First attempt'), ShuffleError('Last attempt')]
+        def generate_here(*args, **kwargs):
+            raise errors.pop(0)
+        with mock.patch('Main.generate', side_effect=generate_here):
+            with self.assertRaisesRegex(ShuffleError, 'Last attempt'):
+                main(settings, max_attempts=2)
+
+
+class TestLogicCache(unittest.TestCase):
+    def test_same_spoiler_as_uncached(self):
+        # Each seed is generated in a new process, with nothing in memory, so the warm run
+        # replays every logic file from disk with the item ids of its own process.
+        ctx = multiprocessing.get_context('spawn')
+        with tempfile.TemporaryDirectory() as cache_output_dir:
+            cache_dir = os.path.join(cache_output_dir, 'Cache')
+            for filename in ['plentiful.sav', 'entrance2.sav']:
+                spoilers = {}
+                for run, logic_cache in [('none', False), ('cold', True), ('warm', True)]:
+                    settings = load_settings(filename, seed='TESTTESTTEST')
+                    settings.output_dir = cache_output_dir
+                    settings.output_file = os.path.join(cache_output_dir, '%s-%s' % (os.path.splitext(filename)[0], run))
+                    settings.logic_cache = logic_cache
+                    with ctx.Pool(1) as pool:
+                        result = pool.apply(generate_batch_seed, ((settings, 0, 10),))
+                    self.assertIsNone(result['error'])
+                    spoilers[run] = load_spoiler(result['spoiler'])
+                    if run == 'cold':
+                        cached_files = {name: os.stat(os.path.join(cache_dir, name)).st_mtime_ns for name in os.listdir(cache_dir)}
+                        self.assertTrue(any(name.startswith('logic-') for name in cached_files))
+                    elif run == 'warm':
+                        # nothing was parsed again
+                        self.assertEqual({name: os.stat(os.path.join(cache_dir, name)).st_mtime_ns for name in os.listdir(cache_dir)}, cached_files)
+                with self.subTest(filename):
+                    self.assertEqual(spoilers['cold'], spoilers['none'])
+                    self.assertEqual(spoilers['warm'], spoilers['none'])
+
+
+class TestProfileStages(unittest.TestCase):
+    def test_profile_written(self):
+        with tempfile.TemporaryDirectory() as profile_dir:
+            settings = make_settings_for_test({'profile_stages': True}, seed='TESTTESTTEST', outfilename='profile')
+            settings.output_file = os.path.join(profile_dir, 'profile')
+            main(settings)
+            profile = load_spoiler('%s_Profile.json' % settings.output_file)
+        stages = {stage['stage']: stage for stage in profile['stages']}
+        for name in ['resolve_settings', 'generate', 'generate/build_world_graphs', 'generate/place_items',
+                     'generate/make_spoiler', 'patch_and_output']:
+            with self.subTest(name):
+                self.assertIn(name, stages)
+                self.assertEqual(stages[name]['calls'], 1)
+                self.assertEqual(stages[name]['depth'], name.count('/'))
+        self.assertGreater(stages['generate/place_items']['searches'], 0)
+        self.assertGreaterEqual(stages['generate']['wall_seconds'], stages['generate/place_items']['wall_seconds'])
+
+
+class TestBatch(unittest.TestCase):
+    def test_same_spoilers_as_single_seeds(self):
+        with tempfile.TemporaryDirectory() as batch_dir:
+            settings = make_settings_for_test({'batch_workers': 2}, seed='TESTTESTTEST', outfilename='batch')
+            settings.output_file = ''
+            settings.output_dir = batch_dir
+            settings.count = 3
+            results = main_batch(settings)
+            self.assertEqual([result['seed'] for result in results], ['TESTTESTTEST-%d' % index for index in range(3)])
+            self.assertEqual(load_spoiler(os.path.join(batch_dir, 'OoT_TESTTESTTEST_Batch.json')), results)
+            for result in results:
+                with self.subTest(result['seed']):
+                    self.assertIsNone(result['error'])
+                    single_settings = make_settings_for_test({}, seed=result['seed'], outfilename='batch-single')
+                    main(single_settings)
+                    self.assertEqual(load_spoiler(result['spoiler']), load_spoiler('%s_Spoiler.json' % single_settings.output_file))
+
+    def test_spawned_worker_loads_rom(self):
+        try:
+            with mock.patch('Main.Rom') as rom:
+                init_batch_worker(None, 'ZOOTDEC.z64')
+            rom.assert_called_once_with('ZOOTDEC.z64')
+            self.assertIs(generate_batch_seed.rom, rom.return_value)
+            init_batch_worker(None, None)
+            self.assertIsNone(generate_batch_seed.rom)
+        finally:
+            generate_batch_seed.rom = None
+
+
+# the locations and items of each sphere, and the entrances of each entrance sphere
+def get_playthroughs(spoiler):
+    playthrough = {sphere: {(location.name, location.world.id): (item.name, item.world.id) for location, item in locations.items()}
+                   for sphere, locations in spoiler.playthrough.items()}
+    entrance_playthrough = {sphere: sorted((entrance.name, entrance.world.id) for entrance in entrances)
+                            for sphere, entrances in spoiler.entrance_playthrough.items()}
+    return playthrough, entrance_playthrough
+
+
+class TestPlaythroughWorkers(unittest.TestCase):
+    def test_same_playthrough_as_series(self):
+        for filename in ['plentiful.sav', 'entrance2.sav']:
+            playthroughs = {}
+            for workers in [1, 3]:
+                settings = load_settings(filename, seed='TESTTESTTEST')
+                settings.playthrough_workers = workers
+                resolve_settings(settings)
+                with mock.patch('Main.run_required_checks', wraps=run_required_checks) as checks:
+                    playthroughs[workers] = get_playthroughs(generate(settings))
+                self.assertEqual(checks.called, workers > 1)
+            with self.subTest(filename):
+                self.assertTrue(playthroughs[1][0])
+                self.assertEqual(bool(playthroughs[1][1]), filename.startswith('entrance'))
+                self.assertEqual(playthroughs[1], playthroughs[3])
+
+    def test_in_worker_processes(self):
+        # Seeds generated in the workers of a batch or of parallel attempts make their checks in series.
+        settings = make_settings_for_test({'batch_workers': 2, 'playthrough_workers': 2}, seed='TESTTESTTEST', outfilename='playthrough-batch')
+        settings.count = 2
+        results = main_batch(settings)
+        self.assertEqual([result['error'] for result in results], [None, None])
+
+        settings = make_settings_for_test({'attempt_workers': 2, 'playthrough_workers': 2}, seed='TESTTESTTEST', outfilename='playthrough-attempts')
+        attempts = [ShuffleError('Failed on purpose'), generate]
+        def generate_here(*args, **kwargs):
+            attempt = attempts.pop(0)
+            if isinstance(attempt, ShuffleError):
+                raise attempt
+            return attempt(*args, **kwargs)
+        with mock.patch('Main.generate', side_effect=generate_here):
+            spoiler = main(settings, max_attempts=2)
+        self.assertTrue(spoiler.playthrough)
+
+
+class TestFillCompatibility(unittest.TestCase):
+    def test_same_spoiler_as_compatibility(self):
+        # The kept max search of the fill must place items exactly as a new search for each item does.
+        for filename in ['plentiful.sav', 'entrance2.sav', 'nightforest.sav', 'multiworld.sav']:
+            spoilers = []
+            for fill_compatibility in [False, True]:
+                with self.subTest(filename, fill_compatibility=fill_compatibility):
+                    settings = load_settings(filename, seed='TESTTESTTEST')
+                    settings.fill_compatibility = fill_compatibility
+                    settings.output_file += '-compatibility' if fill_compatibility else ''
+                    main(settings)
+                    spoilers.append(load_spoiler('%s_Spoiler.json' % settings.output_file))
+            with self.subTest(filename):
+                self.assertEqual(spoilers[0], spoilers[1])
+
+
+class TestCrc(unittest.TestCase):
+    def test_crc_matches_reference(self):
+        rng = random.Random('TESTTESTTEST')
+        inputs = {
+            'zeros': bytes(0x100000),
+            'ones': bytes([0xFF]) * 0x100000,
+            'random': rng.getrandbits(0x800000).to_bytes(0x100000, 'big'),
+            'sparse': bytes(rng.choice([0, 0, 0, rng.getrandbits(8)]) for _ in range(0x100000)),
+        }
+        implementations = [crc.crc_python]
+        if import_numpy() is not None:
+            implementations.append(crc.crc_numpy)
+        for name, m1 in inputs.items():
+            m2 = rng.getrandbits(0x800).to_bytes(0x100, 'big')
+            expected = crc.crc_reference(m1, m2)
+            for implementation in implementations:
+                with self.subTest(name, implementation=implementation.__name__):
+                    self.assertEqual(implementation(m1, m2), expected)
+
+
+# Decodes the sections write_block wrote for one block, returning its data.
+def decode_patch_block(keys, patch_data):
+    data = bytearray()
+    while not patch_data.eof():
+        if patch_data.read_byte() != 0xFF:
+            patch_data.read_int24()
+        else:
+            keys.skip(patch_data.read_byte())
+        section = bytes(patch_data.read_bytes(length=patch_data.read_int16()))
+        data += N64Patch.xor_bytes(section, keys.align(section))
+    return bytes(data)
+
+
+class TestPatchBlocks(unittest.TestCase):
+    def test_key_stream(self):
+        buffer = bytes([9, 0, 1, 2, 0, 0, 3, 0, 4, 9])
+        keys = N64Patch.KeyStream(buffer, (1, 8), 3)
+        # keys are the bytes from 1 to 8 that aren't 0, starting after address 3
+        self.assertEqual(keys.keys, bytes([1, 2, 3, 4]))
+        self.assertEqual(bytes(keys.take(3)), bytes([3, 4, 1]))
+        keys.skip(2)
+        self.assertEqual(keys.next(), 4)
+        keys.rewind(3)
+        self.assertEqual(bytes(keys.take(6)), bytes([2, 3, 4, 1, 2, 3]))
+        self.assertEqual(N64Patch.KeyStream(buffer, (1, 8), 8).next(), 1)
+        # 0s in the data take no key
+        keys = N64Patch.KeyStream(buffer, (1, 8), 0)
+        self.assertEqual(keys.align(bytes([5, 0, 0, 5, 5, 0])), bytes([1, 0, 0, 2, 3, 0]))
+        self.assertEqual(keys.next(), 4)
+
+    def test_xor_bytes(self):
+        self.assertEqual(N64Patch.xor_bytes(bytes([0, 1, 0xFF, 0x80]), bytes([0, 3, 0x0F, 0x80])), bytes([0, 2, 0xF0, 0]))
+        self.assertEqual(N64Patch.xor_bytes(b'', b''), b'')
+
+    def test_write_block_round_trip(self):
+        rng = random.Random('TESTTESTTEST')
+        key_buffers = {
+            'random': rng.getrandbits(0x8000 * 8).to_bytes(0x8000, 'big'),
+            # long runs of the same key force key skips of 255 and more
+            'repeated': bytes([7] * 600 + [0, 3] + [7] * 300 + [5]) * 8,
+        }
+        blocks = {
+            'short': bytes([5]),
+            # longer than the chunks data is XORed in, with keys matching across chunk boundaries
+            'straddling': bytes(rng.choice([0, 7, 7, 3]) for _ in range(0x3000)),
+            'random': rng.getrandbits(0x20000 * 8).to_bytes(0x20000, 'big'),
+            # a 0 right at the end of the longest section
+            'zero at limit': bytes([0xAA] * 0xFFFE + [0] + [0xAA] * 10),
+        }
+        for numpy in ([True, False] if import_numpy() is not None else [False]):
+            with mock.patch('N64Patch.import_numpy', return_value=import_numpy() if numpy else None):
+                for key_name, key_buffer in key_buffers.items():
+                    for block_name, block in blocks.items():
+                        with self.subTest(key_name, block=block_name, numpy=numpy):
+                            key_range = (0x10, len(key_buffer) - 0x10)
+                            patch_data = BigStream(bytearray())
+                            N64Patch.write_block(N64Patch.KeyStream(key_buffer, key_range, 0x20), 0x1234, block, patch_data)
+                            patch_data = BigStream(bytes(patch_data.buffer))
+                            self.assertEqual(patch_data.read_int32(), 0x1234)
+                            patch_data.seek_address(0)
+                            keys = N64Patch.KeyStream(key_buffer, key_range, 0x20)
+                            self.assertEqual(decode_patch_block(keys, patch_data), block)
+
+
+# A 16 MB base rom of random data with a small DMA table, which includes
+# the table's own entry.
+def make_patch_base_rom():
+    rng = random.Random('TESTTESTTEST')
+    base = Rom()
+    base.buffer = OverlayBuffer(rng.getrandbits(0x1000000 * 8).to_bytes(0x1000000, 'big'))
+    base.write_bytes(0x7430, bytes(0x400))
+    base.write_int32s(0x7430, [0x7430, 0x7830, 0x7430, 0])
+    base.write_int32s(0x7440, [0x10000, 0x12000, 0x10000, 0])
+    base.write_int32s(0x7450, [0x20000, 0x20800, 0x20000, 0])
+    base.original = base.copy()
+    return base
+
+
+class TestRomFile(unittest.TestCase):
+    def test_base_rom_is_private(self):
+        with tempfile.TemporaryDirectory() as directory:
+            rom_path = os.path.join(directory, 'test.z64')
+            with open(rom_path, 'wb') as outfile:
+                outfile.write(bytes(range(256)) * 0x100)
+            rom = Rom()
+            rom.read_rom(rom_path)
+            copied = rom.copy()
+            rom.write_bytes(0x10, [0xFF] * 0x10)
+            # later changes to the file don't show up in the rom
+            with open(rom_path, 'wb') as outfile:
+                outfile.write(bytes(0x10))
+            self.assertEqual(rom.read_bytes(0x0, 0x30), bytes(range(0x10)) + bytes([0xFF] * 0x10) + bytes(range(0x20, 0x30)))
+            self.assertEqual(copied.read_bytes(0xFFF0, 0x10), bytes(range(0xF0, 0x100)))
+            self.assertEqual(len(copied.buffer), 0x10000)
+
+
+class TestPatchFile(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rng = random.Random('TESTTESTTEST')
+        cls.base = make_patch_base_rom()
+        rom = cls.base.copy()
+        rom.original = cls.base
+        rom.write_bytes(0x35, [1, 2, 3])
+        rom.force_patch.extend([0x35, 0x36, 0x37])
+        # unchanged writes, and writes across pages up to either side of the DMA table
+        rom.write_bytes(0x40000, cls.base.read_bytes(0x40000, 0x2000))
+        rom.write_bytes(0x7000, rng.getrandbits(0x430 * 8).to_bytes(0x430, 'big'))
+        rom.write_bytes(0x7830, rng.getrandbits(0x900 * 8).to_bytes(0x900, 'big'))
+        rom.write_bytes(0x80FF0, bytes(0x20))
+        rom.write_bytes(0x100000, rng.getrandbits(0x30000 * 8).to_bytes(0x30000, 'big'))
+        for address in range(0x200000, 0x210000, 0x100):
+            rom.write_int32(address, rng.getrandbits(32))
+        rom.write_bytes(0xB8AD30, bytes(0x100))
+        # a moved file and a new file
+        rom.update_dmadata_record(0x10000, 0x800000, 0x803000)
+        rom.write_bytes(0x802000, [0xAB] * 0x800)
+        rom.update_dmadata_record(None, 0x900000, 0x900100)
+        rom.write_bytes(0x900010, [0xCD] * 0x10)
+        cls.rom = rom
+
+    # Writing a patch marks the moved files as changed, so each patch is
+    # written from a copy of the rom.
+    def copy_rom(self, rom):
+        new_rom = rom.copy()
+        new_rom.original = self.base
+        return new_rom
+
+    def apply_patch(self, patch_data):
+        target = self.copy_rom(self.base)
+        N64Patch.read_patch_data(target, patch_data)
+        return target
+
+    def test_patch_round_trip(self):
+        for numpy in ([True, False] if import_numpy() is not None else [False]):
+            with self.subTest(numpy=numpy), \
+                    mock.patch('N64Patch.import_numpy', return_value=import_numpy() if numpy else None), \
+                    tempfile.TemporaryDirectory() as directory:
+                patch_path = os.path.join(directory, 'test.zpf')
+                N64Patch.create_patch_file(self.copy_rom(self.rom), patch_path)
+                target = self.copy_rom(self.base)
+                N64Patch.apply_patch_file(target, patch_path)
+                self.assertEqual(target.buffer[:], self.rom.buffer[:])
+
+    def test_patch_stream_chunks(self):
+        # small chunks, so that every value in the patch straddles chunk boundaries
+        stream = io.BytesIO()
+        patch_data = N64Patch.PatchWriter(stream, chunk_size=0x7)
+        N64Patch.write_patch_data(self.copy_rom(self.rom), patch_data, (0x00B8AD30, 0x00F029A0))
+        patch_data.close()
+        patch = stream.getvalue()
+
+        target = self.apply_patch(N64Patch.PatchReader(io.BytesIO(patch), chunk_size=0x5))
+        self.assertEqual(target.buffer[:], self.rom.buffer[:])
+
+        with self.assertRaisesRegex(Exception, 'truncated'):
+            self.apply_patch(N64Patch.PatchReader(io.BytesIO(patch[:len(patch) // 2]), chunk_size=0x5))
+
+    def test_patch_reader_in_order(self):
+        stream = io.BytesIO()
+        patch_data = N64Patch.PatchWriter(stream, chunk_size=0x3)
+        patch_data.append_bytes(b'ZPFv1')
+        patch_data.append_int32(0x12345678)
+        patch_data.close()
+        patch_data = N64Patch.PatchReader(io.BytesIO(stream.getvalue()), chunk_size=0x2)
+        self.assertEqual(patch_data.read_bytes(length=5), b'ZPFv1')
+        self.assertEqual(patch_data.read_int32(), 0x12345678)
+        self.assertTrue(patch_data.eof())
+        with self.assertRaisesRegex(Exception, 'in order'):
+            patch_data.read_byte(0)
 
 
 class TestValidSpoilers(unittest.TestCase):
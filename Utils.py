@@ -1,5 +1,7 @@
+import hashlib
 import io
 import json
+import marshal
 import os, os.path
 import subprocess
 import sys
@@ -45,6 +47,22 @@ def data_path(path=''):
 data_path.cached_path = None
 
 
+# Returns the numpy module, or None if it isn't installed. It's only imported
+# the first time it's asked for, since loading it takes a lot of memory.
+def import_numpy():
+    if not import_numpy.tried:
+        import_numpy.tried = True
+        try:
+            import numpy
+            import_numpy.module = numpy
+        except ImportError:
+            pass
+    return import_numpy.module
+
+import_numpy.tried = False
+import_numpy.module = None
+
+
 def default_output_path(path):
     if path == '':
         path = local_path('Output')
@@ -54,12 +72,16 @@ def default_output_path(path):
     return path
 
 
-def read_json(file_path):
-    json_string = ""
-    with io.open(file_path, 'r', encoding = "utf-8") as file:
-        for line in file.readlines():
-            json_string += line.split('#')[0].replace('\n', ' ')
-    json_string = re.sub(' +', ' ', json_string)
+# Comments run from '#' to the end of the line and take the line break with them.
+json_comment = re.compile(r'#[^\n]*\n?')
+json_spaces = re.compile(' +')
+
+
+def strip_json_comments(text):
+    return json_spaces.sub(' ', json_comment.sub('', text).replace('\n', ' '))
+
+
+def parse_json(json_string):
     try:
         return json.loads(json_string)
     except json.JSONDecodeError as error:
@@ -68,6 +90,53 @@ def read_json(file_path):
                         "                                   ^^\n")
 
 
+# Parsed files are kept marshalled, so every caller gets its own copy to modify.
+# If read_json.cache_dir is set, they are also kept there across runs.
+# Entries are keyed by path, modification time and size, so edited files are reread.
+def read_json(file_path):
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+    data = read_json.cached_files.pop(key, None)
+    if data is None:
+        data = read_json_marshalled(key)
+    # Most recently used entries are kept at the end.
+    read_json.cached_files[key] = data
+    while len(read_json.cached_files) > read_json.max_cached_files:
+        del read_json.cached_files[next(iter(read_json.cached_files))]
+    return marshal.loads(data)
+
+read_json.cached_files = {}
+read_json.max_cached_files = 256
+read_json.cache_dir = None
+
+
+def read_json_marshalled(key):
+    cache_path = None
+    if read_json.cache_dir is not None:
+        digest = hashlib.sha256(repr((key, marshal.version, sys.version)).encode()).hexdigest()
+        cache_path = os.path.join(read_json.cache_dir, 'json-%s.marshal' % digest)
+        try:
+            with open(cache_path, 'rb') as file:
+                return file.read()
+        except OSError:
+            pass
+
+    with io.open(key[0], 'r', encoding = "utf-8") as file:
+        data = marshal.dumps(parse_json(strip_json_comments(file.read())))
+
+    if cache_path is not None:
+        try:
+            os.makedirs(read_json.cache_dir, exist_ok=True)
+            # Write to a temporary file first, so concurrent runs never read a partial entry.
+            temp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+            with open(temp_path, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            pass
+    return data
+
+
 def open_file(filename):
     if sys.platform == 'win32':
         os.startfile(filename)
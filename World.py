@@ -14,6 +14,7 @@ from Item import ItemFactory, ItemInfo, MakeEventItem
 from Location import Location, LocationFactory
 from LocationList import business_scrubs
 from Plandomizer import InvalidFileException
+from Profiler import profile_stage
 from Region import Region, TimeOfDay
 from Rules import set_rules, set_shop_rules
 from RuleParser import Rule_AST_Transformer
@@ -32,6 +33,9 @@ class World(object):
         self._entrance_cache = {}
         self._region_cache = {}
         self._location_cache = {}
+        # One past the highest region and location index in this world, see index_spots
+        self.region_index_end = 0
+        self.location_index_end = 0
         self.required_locations = []
         self.shop_prices = {}
         self.scrub_prices = {}
@@ -43,6 +47,9 @@ class World(object):
 
         self.parser = Rule_AST_Transformer(self)
         self.event_items = set()
+        # item id -> Locations and Entrances whose access rule has been blocked
+        # on that item by some Search. Dicts used as ordered sets. Only ever grows.
+        self.rule_dependents = {}
 
         # dump settings directly into world's namespace
         # this gives the world an attribute for every setting listed in Settings.py
@@ -259,6 +266,8 @@ class World(object):
         new_world.triforce_count = self.triforce_count
         new_world.total_starting_triforce_count = self.total_starting_triforce_count
         new_world.maximum_wallets = self.maximum_wallets
+        new_world.region_index_end = self.region_index_end
+        new_world.location_index_end = self.location_index_end
         new_world.distribution = self.distribution
 
         new_world.regions = [region.copy(new_world) for region in self.regions]
@@ -404,7 +413,16 @@ class World(object):
 
 
     def load_regions_from_json(self, file_path):
-        region_json = read_json(file_path)
+        template = self.parser.open_logic_cache(file_path)
+        if template is not None:
+            # Another world already loaded this file with the same logic.
+            self.clone_regions(template)
+            self.parser.close_logic_cache()
+            return
+
+        with profile_stage('read_json'):
+            region_json = read_json(file_path)
+        first_region = len(self.regions)
             
         for region in region_json:
             new_region = Region(region['region_name'])
@@ -464,6 +482,68 @@ class World(object):
                     else:
                         new_region.exits.append(new_exit)
             self.regions.append(new_region)
+        self.parser.close_logic_cache(self.region_template(self.regions[first_region:]))
+
+
+    # A snapshot of freshly loaded regions, from which clone_regions builds the same
+    # regions for another world. Rules and location metadata are shared, not copied,
+    # but lists are, since rules are later added to the loaded spots in place.
+    @staticmethod
+    def region_template(regions):
+        def fields(spot):
+            return {name: list(value) if isinstance(value, list) else value for name, value in spot.__dict__.items()}
+        return [(dict(region.__dict__),
+                 [(fields(location), location.item.name if location.item else None) for location in region.locations],
+                 [fields(exit) for exit in region.exits])
+                for region in regions]
+
+
+    # Adds regions to this world from a template, rebinding only the per-world fields.
+    # Equivalent to loading the logic file the template was taken from.
+    def clone_regions(self, template):
+        for region_fields, locations, exits in template:
+            new_region = Region.__new__(Region)
+            new_region.__dict__.update(region_fields)
+            new_region.world = self
+            new_region.entrances = []
+            new_region.locations = []
+            new_region.exits = []
+            for location_fields, event in locations:
+                new_location = Location.__new__(Location)
+                new_location.__dict__.update(location_fields)
+                new_location.parent_region = new_region
+                new_location.world = self
+                new_location.item = None
+                new_location.access_rules = list(new_location.access_rules)
+                if new_location.filter_tags is not None:
+                    new_location.filter_tags = list(new_location.filter_tags)
+                new_region.locations.append(new_location)
+                if event:
+                    MakeEventItem(event, new_location)
+            for exit_fields in exits:
+                new_exit = Entrance.__new__(Entrance)
+                new_exit.__dict__.update(exit_fields)
+                new_exit.parent_region = new_region
+                new_exit.world = self
+                new_exit.access_rules = list(new_exit.access_rules)
+                new_region.exits.append(new_exit)
+            self.regions.append(new_region)
+
+
+    # Numbers the regions and locations of this world, starting from the given indices.
+    # Indices are unique across the worlds of a generation, so a Search can store
+    # reachability for all of them in flat arrays. Copies of the world keep them.
+    # Returns the next free region and location indices.
+    def index_spots(self, region_index=0, location_index=0):
+        for region in self.regions:
+            region.index = region_index
+            region_index += 1
+            for location in region.locations:
+                location.index = location_index
+                location_index += 1
+        self.region_index_end = region_index
+        self.location_index_end = location_index
+        return region_index, location_index
 
 
     def create_internal_locations(self):
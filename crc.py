@@ -1,15 +1,39 @@
 import itertools
+import operator
+import struct
+from functools import reduce
 from ntype import BigStream, uint32
+from Utils import import_numpy
+
+
+CRC_SEED = 0xDF26F436
+u32 = 0xFFFFFFFF
+
+
+# The data the checksum covers: the first 1 MB after the boot code, and 0x100
+# bytes of the boot code that are cycled through alongside it.
+def crc_data(rom):
+    return rom.read_bytes(0x1000, 0x100000), rom.read_bytes(0x750, 0x100)
+
 
 def calculate_crc(self):
+    return crc_from_data(*crc_data(self))
 
-    t1 = t2 = t3 = t4 = t5 = t6 = 0xDF26F436
-    u32 = 0xFFFFFFFF
 
-    m1 = self.read_bytes(0x1000, 0x100000)
-    words = map(uint32.value, zip(m1[0::4], m1[1::4], m1[2::4], m1[3::4]))
+def crc_from_data(m1, m2):
+    if import_numpy() is not None:
+        return crc_numpy(m1, m2)
+    # the pure python checksum is used instead
+    return crc_python(m1, m2)
+
+
+# The checksum as the boot code computes it, one word at a time. The faster
+# versions below are checked against this one.
+def crc_reference(m1, m2):
+
+    t1 = t2 = t3 = t4 = t5 = t6 = CRC_SEED
 
-    m2 = self.read_bytes(0x750, 0x100)
+    words = map(uint32.value, zip(m1[0::4], m1[1::4], m1[2::4], m1[3::4]))
     words2 = map(uint32.value, zip(m2[0::4], m2[1::4], m2[2::4], m2[3::4]))
 
     for d, d2 in zip(words, itertools.cycle(words2)):
@@ -33,4 +57,68 @@ def calculate_crc(self):
     crc0 = (t6 ^ t4 ^ t3) & u32
     crc1 = (t5 ^ t2 ^ t1) & u32
 
-    return uint32.bytes(crc0) + uint32.bytes(crc1)
\ No newline at end of file
+    return uint32.bytes(crc0) + uint32.bytes(crc1)
+
+
+# Every term but t2 is a sum or xor over the words, so only t2 needs a loop.
+# t4 counts the times the running sum t6 wraps around, which is how many
+# times 2**32 goes into the full sum, since no word can wrap it twice.
+def crc_python(m1, m2):
+    words = struct.unpack('>%dI' % (len(m1) // 4), m1)
+    words2 = struct.unpack('>%dI' % (len(m2) // 4), m2)
+
+    total = CRC_SEED + sum(words)
+    t4 = CRC_SEED + (total >> 32)
+    t6 = total & u32
+    t3 = reduce(operator.xor, words, CRC_SEED)
+    t1 = CRC_SEED + sum(map(operator.xor, words, itertools.cycle(words2)))
+
+    t2 = t5 = CRC_SEED
+    sums = CRC_SEED
+    for d in words:
+        sums = (sums + d) & u32
+        shift = d & 0x1F
+        r = ((d << shift) | (d >> (32 - shift))) & u32
+        t5 += r
+        if t2 > d:
+            t2 ^= r
+        else:
+            t2 ^= sums ^ d
+
+    crc0 = (t6 ^ t4 ^ t3) & u32
+    crc1 = (t5 ^ t2 ^ t1) & u32
+
+    return uint32.bytes(crc0) + uint32.bytes(crc1)
+
+
+# Computes every term but t2 over whole arrays. The running sums and rotated
+# words t2 is built from are computed up front, so its loop only picks which
+# one to xor in at each word.
+def crc_numpy(m1, m2):
+    numpy = import_numpy()
+    words = numpy.frombuffer(bytes(m1), dtype='>u4').astype(numpy.uint64)
+    words2 = numpy.frombuffer(bytes(m2), dtype='>u4').astype(numpy.uint64)
+
+    # at most 2**18 words of 32 bits each, so the sums can't overflow 64 bits
+    sums = numpy.cumsum(words) + CRC_SEED
+    total = int(sums[-1])
+    t4 = CRC_SEED + (total >> 32)
+    t6 = total & u32
+    t3 = CRC_SEED ^ int(numpy.bitwise_xor.reduce(words))
+    t1 = CRC_SEED + int((numpy.resize(words2, len(words)) ^ words).sum())
+
+    shifts = words & 0x1F
+    rotated = ((words << shifts) | (words >> (32 - shifts))) & u32
+    t5 = CRC_SEED + int(rotated.sum())
+
+    t2 = CRC_SEED
+    for d, r, x in zip(words.tolist(), rotated.tolist(), ((sums & u32) ^ words).tolist()):
+        if t2 > d:
+            t2 ^= r
+        else:
+            t2 ^= x
+
+    crc0 = (t6 ^ t4 ^ t3) & u32
+    crc1 = (t5 ^ t2 ^ t1) & u32
+
+    return uint32.bytes(crc0) + uint32.bytes(crc1)